@@ -0,0 +1,181 @@
+"""Storage for extracted art: either a plain directory or a single uncompressed zip archive.
+
+Both kinds of storage have the same small interface (Open, Read, Exists, Size), with member names such as 'bitmaps/0.bmp' relative to the top of
+the directory or archive, so the extractor, the builder and the metadata code don't care which one they are working with.
+
+Archive members are stored uncompressed, so the reader can memory-map the archive and hand out members as read-only views into the mapping,
+without unpacking anything.  Reading from a member opened as a file only copies the bytes that are read.
+"""
+
+import cStringIO
+import io
+import mmap
+import os
+import struct
+import threading
+import zipfile
+
+# fixed part of a zip local file header (see the zip APPNOTE), which precedes each member's data
+ZIP_LOCAL_HEADER = struct.Struct('<4s 2B 4H 3I 2H')
+ZIP_LOCAL_SIGNATURE = 'PK\x03\x04'
+# modification time given to every member, so that extracting the same files always produces the same archive
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+class ArchiveError(Exception):
+    pass
+
+def IsArchive(path):
+    """Returns whether path is an archive rather than a directory."""
+    return os.path.isfile(path) and zipfile.is_zipfile(path)
+
+class Directory(object):
+    """Members are files in the directory path."""
+    def __init__(self, path):
+        self.path = path
+
+    def Path(self, name):
+        """Returns the filename of member name."""
+        return os.path.join(self.path, *name.split('/'))
+
+    def Open(self, name, mode='rb'):
+        return open(self.Path(name), mode)
+
+    def Read(self, name):
+        with self.Open(name) as f:
+            return f.read()
+
+    def Exists(self, name):
+        return os.path.exists(self.Path(name))
+
+    def Size(self, name):
+        return os.path.getsize(self.Path(name))
+
+    def Close(self):
+        pass
+
+class _Member(object):
+    """File object that collects the data of an archive member, and adds it to the archive when closed."""
+    def __init__(self, writer, name):
+        self._writer = writer
+        self._name = name
+        self._f = cStringIO.StringIO()
+
+    def write(self, data):
+        self._f.write(data)
+
+    def close(self):
+        if self._f is not None:
+            self._writer.Write(self._name, self._f.getvalue())
+            self._f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        # a member whose writer failed is left out of the archive altogether
+        if exc_info[0] is None:
+            self.close()
+        self._f = None
+
+class _MemberReader(io.RawIOBase):
+    """Read-only raw file over an archive member's data, copying only the bytes that are read."""
+    def __init__(self, data):
+        io.RawIOBase.__init__(self)
+        self._data = data
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        data = self._data[self._pos:self._pos + len(b)]
+        b[:len(data)] = data
+        self._pos = self._pos + len(data)
+        return len(data)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset = offset + self._pos
+        elif whence == os.SEEK_END:
+            offset = offset + len(self._data)
+        self._pos = max(0, offset)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+class ZipWriter(object):
+    """Writes members to a new uncompressed zip archive, in the order they are written.  Safe to use from multiple threads."""
+    def __init__(self, filename):
+        self._zip = zipfile.ZipFile(filename, 'w', zipfile.ZIP_STORED, allowZip64=True)
+        self._lock = threading.Lock()
+
+    def Write(self, name, data):
+        info = zipfile.ZipInfo(name, ZIP_DATE_TIME)
+        info.compress_type = zipfile.ZIP_STORED
+        info.external_attr = 0644 << 16
+        # unix permissions, whatever system the archive is written on
+        info.create_system = 3
+        with self._lock:
+            self._zip.writestr(info, data)
+
+    def Open(self, name, mode='wb'):
+        if 'r' in mode:
+            raise ArchiveError('archives being written cannot be read from')
+        return _Member(self, name)
+
+    def Exists(self, name):
+        with self._lock:
+            return name in self._zip.NameToInfo
+
+    def Size(self, name):
+        with self._lock:
+            return self._zip.getinfo(name).file_size
+
+    def Close(self):
+        self._zip.close()
+
+class ZipReader(object):
+    """Reads members of a zip archive through a memory mapping.  Safe to use from multiple threads."""
+    def __init__(self, filename):
+        self._file = open(filename, 'rb')
+        self._zip = zipfile.ZipFile(self._file)
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def Read(self, name):
+        """Returns the data of member name: a read-only view into the mapped archive if it is stored uncompressed, otherwise a decompressed copy."""
+        try:
+            info = self._zip.getinfo(name)
+        except KeyError:
+            raise ArchiveError('%s is not in the archive' % name)
+        if info.compress_type != zipfile.ZIP_STORED:
+            return self._zip.read(info)
+        # the local header can have a different extra field than the central directory, so its size has to be read from the header itself
+        if info.header_offset + ZIP_LOCAL_HEADER.size > len(self._map):
+            raise ArchiveError('%s: truncated archive' % name)
+        fields = ZIP_LOCAL_HEADER.unpack_from(self._map, info.header_offset)
+        if fields[0] != ZIP_LOCAL_SIGNATURE:
+            raise ArchiveError('%s: bad local header' % name)
+        start = info.header_offset + ZIP_LOCAL_HEADER.size + fields[-2] + fields[-1]
+        if start + info.file_size > len(self._map):
+            raise ArchiveError('%s: truncated archive' % name)
+        return buffer(self._map, start, info.file_size)
+
+    def Open(self, name, mode='rb'):
+        if 'r' not in mode:
+            raise ArchiveError('archives being read cannot be written to')
+        return io.BufferedReader(_MemberReader(self.Read(name)))
+
+    def Exists(self, name):
+        return name in self._zip.NameToInfo
+
+    def Size(self, name):
+        return self._zip.getinfo(name).file_size
+
+    def Close(self):
+        self._map.close()
+        self._zip.close()
+        self._file.close()
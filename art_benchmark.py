@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+"""Benchmarks loading, writing, extracting and rebuilding a synthetic op2_art pair (see synthetic_art)."""
+
+import argparse
+import cStringIO
+import filecmp
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import timeit
+
+import art_builder
+import art_extractor
+import metadata
+import prt_file
+import synthetic_art
+
+RESULTS_VERSION = 1
+PHASES = ['load', 'write', 'extract', 'build', 'round_trip']
+
+def _RunMain(main, argv):
+    """Runs a command line program's main() in-process with the given arguments and its output suppressed."""
+    old_argv = sys.argv
+    old_stdout = sys.stdout
+    sys.argv = [main.__module__] + argv
+    sys.stdout = cStringIO.StringIO()
+    try:
+        main()
+    finally:
+        sys.argv = old_argv
+        sys.stdout = old_stdout
+
+def _Identical(prt_a, bmp_a, prt_b, bmp_b):
+    return filecmp.cmp(prt_a, prt_b, shallow=False) and filecmp.cmp(bmp_a, bmp_b, shallow=False)
+
+def _Benchmark(work_dir, args):
+    """Runs every phase args.repeat times.  Returns the timings of each run per phase and whether the round trips were byte-identical."""
+    prt_path = os.path.join(work_dir, 'op2_art.prt')
+    bmp_path = os.path.join(work_dir, 'op2_art.bmp')
+    write_prt = os.path.join(work_dir, 'write.prt')
+    write_bmp = os.path.join(work_dir, 'write.bmp')
+    build_prt = os.path.join(work_dir, 'build.prt')
+    build_bmp = os.path.join(work_dir, 'build.bmp')
+    extract_dir = os.path.join(work_dir, 'extracted')
+    timings = dict((phase, []) for phase in PHASES)
+    identical = {'write': True, 'round_trip': True}
+    for run in xrange(args.repeat):
+        start = timeit.default_timer()
+        with open(prt_path, 'rb') as prt:
+            with open(bmp_path, 'rb') as bmp:
+                loaded = prt_file.PRTFile(prt, bmp)
+                loaded.Load()
+        timings['load'].append(timeit.default_timer() - start)
+
+        start = timeit.default_timer()
+        with open(write_prt, 'wb') as prt:
+            with open(write_bmp, 'wb') as bmp:
+                out = prt_file.PRTFile(prt, bmp)
+                out.palettes = loaded.palettes
+                out.bitmaps = loaded.bitmaps
+                out.animations = loaded.animations
+                out.num_optional_entries = loaded.num_optional_entries
+                out.extra_data = loaded.extra_data
+                out.Write()
+        timings['write'].append(timeit.default_timer() - start)
+        identical['write'] = identical['write'] and _Identical(prt_path, bmp_path, write_prt, write_bmp)
+
+        shutil.rmtree(extract_dir, ignore_errors=True)
+        start = timeit.default_timer()
+        # ACT palettes don't keep the flags, so use the format that round-trips
+        _RunMain(art_extractor.main, [prt_path, bmp_path, extract_dir, '--palette_format', 'pal', '--metadata_format', args.metadata_format,
+                '--jobs', str(args.jobs)])
+        timings['extract'].append(timeit.default_timer() - start)
+
+        start = timeit.default_timer()
+        _RunMain(art_builder.main, [extract_dir, build_prt, build_bmp, '--palette_format', 'pal', '--jobs', str(args.jobs)])
+        timings['build'].append(timeit.default_timer() - start)
+        timings['round_trip'].append(timings['extract'][-1] + timings['build'][-1])
+        identical['round_trip'] = identical['round_trip'] and _Identical(prt_path, bmp_path, build_prt, build_bmp)
+    return timings, identical
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the OP2_ART tools on synthetic data.')
+    parser.add_argument('--output', help='Writes the results as JSON to this file.')
+    parser.add_argument('--baseline', help='Results file (from --output) of an earlier run to compare against.  Exits with an error if any phase is '
+        'slower than the baseline by more than --tolerance.')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Allowed slowdown relative to the baseline (default 0.1, i.e. 10%%).')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of times to run each phase; the fastest run counts (default 3).')
+    parser.add_argument('--work_dir', help='Directory for the generated and intermediate files, which are kept.  A temporary directory is used (and '
+        'removed) by default.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for the synthetic data (default 0).')
+    parser.add_argument('--palettes', type=int, default=8, help='Number of palettes (default 8).')
+    parser.add_argument('--bitmaps', type=int, default=1000, help='Number of bitmaps (default 1000).')
+    parser.add_argument('--animations', type=int, default=500, help='Number of animations (default 500).')
+    parser.add_argument('--max_frames', type=int, default=8, help='Maximum number of frames per animation (default 8).')
+    parser.add_argument('--max_subframes', type=int, default=4, help='Maximum number of subframes per frame (default 4).')
+    parser.add_argument('--metadata_format', default='yaml', choices=sorted(metadata.METADATA_FORMATS.keys()), help='Metadata format for extract/build '
+        '(default yaml).')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of worker threads for extract/build (default 1).')
+    args = parser.parse_args()
+    if args.repeat < 1:
+        parser.error('--repeat must be at least 1')
+    params = {
+        'seed': args.seed,
+        'num_palettes': args.palettes,
+        'num_bitmaps': args.bitmaps,
+        'num_animations': args.animations,
+        'max_frames': args.max_frames,
+        'max_subframes': args.max_subframes,
+    }
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='op2_art_benchmark')
+    try:
+        if not os.path.isdir(work_dir):
+            os.makedirs(work_dir)
+        print 'Generating synthetic op2_art data...'
+        with open(os.path.join(work_dir, 'op2_art.prt'), 'wb') as prt:
+            with open(os.path.join(work_dir, 'op2_art.bmp'), 'wb') as bmp:
+                generated = synthetic_art.GenerateArt(prt, bmp, **params)
+        sizes = {
+            'prt_bytes': os.path.getsize(os.path.join(work_dir, 'op2_art.prt')),
+            'bmp_bytes': os.path.getsize(os.path.join(work_dir, 'op2_art.bmp')),
+            'frames': generated.animations.NumFrames(),
+            'subframes': generated.animations.NumSubframes(),
+        }
+        print 'Running benchmarks...'
+        timings, identical = _Benchmark(work_dir, args)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    results = {
+        'version': RESULTS_VERSION,
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'params': params,
+        'options': {'metadata_format': args.metadata_format, 'jobs': args.jobs, 'repeat': args.repeat},
+        'sizes': sizes,
+        'phases': dict((phase, {'seconds': min(runs), 'runs': runs}) for phase, runs in timings.iteritems()),
+        'identical': identical,
+    }
+    failed = False
+    for name in sorted(identical):
+        if not identical[name]:
+            print '%s output is NOT byte-identical to the input' % name
+            failed = True
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if baseline.get('version') != RESULTS_VERSION:
+            parser.error('%s: unsupported results version' % args.baseline)
+        if baseline.get('params') != params or baseline.get('options') != results['options']:
+            print 'Warning: the baseline was run with different parameters or options'
+    for phase in PHASES:
+        seconds = results['phases'][phase]['seconds']
+        line = '%-10s %8.3fs' % (phase, seconds)
+        if baseline and phase in baseline['phases']:
+            old = baseline['phases'][phase]['seconds']
+            ratio = seconds / old if old else 1.0
+            line = line + '  (baseline %.3fs, %+.1f%%)' % (old, (ratio - 1) * 100)
+            if ratio > 1 + args.tolerance:
+                line = line + '  REGRESSION'
+                failed = True
+        print line
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
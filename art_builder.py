@@ -2,65 +2,204 @@
 """Main program to recompile OP2_ART .prt and .bmp files from human-readable files."""
 
 import argparse
-import os
+import functools
+import multiprocessing.pool
 import sys
-import yaml
 
+import archive
 import bitmap
+import build_cache
+import metadata
+import metrics
 import palette
+import palette_interning
 import prt_file
+import quantize
+
+def _LoadBitmap(job, storage, cache=None, allow_truecolor=False):
+    """Loads one bitmap for a (filename, image type, palette id) job from storage (see archive), or from the build cache if it has it."""
+    filename, image_type, palette_id = job
+    segment = cache.Lookup(storage.Path(filename), 'bitmap') if cache else None
+    if segment is not None:
+        bmp = build_cache.DecodeBitmap(segment)
+    else:
+        bmp = bitmap.Bitmap()
+        with storage.Open(filename) as f:
+            bmp.LoadBMPFromOpenFile(f, allow_truecolor=allow_truecolor)
+        # truecolor images are not cached at all, since what they are mapped to depends on the palette (and --dither), not just the file
+        if cache and bmp.rgb is None:
+            cache.Store(storage.Path(filename), 'bitmap', build_cache.EncodeBitmap(bmp))
+    bmp.image_type = image_type
+    bmp.palette_id = palette_id
+    if bmp.rgb is None and len(bmp.data) != bmp.Stride() * bmp.height:
+        raise bitmap.BitmapLoadError('%s: pixel data does not match image type %d (%dbpp)' % (filename, image_type, bmp.BitsPerPixel()))
+    return bmp
+
+def _LoadPalette(job, storage, cache=None):
+    """Loads one palette for a (filename, file format) job from storage (see archive), or from the build cache if it has it."""
+    filename, file_format = job
+    kind = 'palette_%d' % file_format
+    segment = cache.Lookup(storage.Path(filename), kind) if cache else None
+    if segment is not None:
+        return build_cache.DecodePalette(segment)
+    pal = palette.Palette()
+    with storage.Open(filename) as f:
+        pal.LoadPALFromOpenFile(f, file_format=file_format)
+    if cache:
+        cache.Store(storage.Path(filename), kind, build_cache.EncodePalette(pal))
+    return pal
 
 def main():
     parser = argparse.ArgumentParser(description='Recompiles OP2_ART assets from human-readable formats.')
-    parser.add_argument('input', help='Input directory to read data from.')
+    parser.add_argument('input', help='Input directory to read data from, or an archive written by art_extractor.py --archive.')
     parser.add_argument('prt', type=argparse.FileType('wb'), help='Path to output op2_art.prt.')
     parser.add_argument('bmp', type=argparse.FileType('wb'), help='Path to output op2_art.bmp.')
     parser.add_argument('--palette_format', default='act', choices=palette.PAL_FORMATS.keys(), help='Palette format to read.  Choices are pal (Microsoft .pal '
         'format), text (.pal text format supported by Paint Shop Pro), or act (Photoshop .act color table, default).')
     parser.add_argument('--palettes_from_bitmaps', action='store_true', default=False, help='Reads palettes directly from input bitmaps if set, ignoring the '
-        'palette files and metadata.  This will result in a unique palette entry for each loaded bitmap in the PRT file, which will increase its size as well '
-        'as the amount of time it takes Outpost 2 to load the data, but allowing for greater flexibility with colors.')
+        'palette files and metadata.  Bitmaps with identical palettes share a single palette entry in the PRT file, but every distinct bitmap palette '
+        'adds an entry, which increases its size as well as the amount of time it takes Outpost 2 to load the data, in exchange for greater flexibility '
+        'with colors.')
+    parser.add_argument('--merge_palettes', action='store_true', default=False, help='With --palettes_from_bitmaps, also lets bitmaps share a palette '
+        'entry when their palettes only differ in colors that the bitmaps do not use.')
+    parser.add_argument('--truecolor', action='store_true', default=False, help='Accepts 24- and 32-bpp input bitmaps, mapping each pixel to the '
+        'nearest color in the bitmap\'s palette.')
+    parser.add_argument('--dither', action='store_true', default=False, help='With --truecolor, applies Floyd-Steinberg dithering when mapping '
+        'colors.')
+    parser.add_argument('--lut_cache_dir', help='With --truecolor, directory in which to keep the per-palette color lookup tables between builds.')
+    parser.add_argument('--dedup_bitmaps', action='store_true', default=False, help='Stores bitmaps with identical pixel data only once in '
+        'op2_art.bmp.')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of worker threads used to read the bitmap and palette files (default 1).')
+    parser.add_argument('--metadata_format', choices=sorted(metadata.METADATA_FORMATS.keys()), help='Format of the bitmap and animation metadata '
+        'files (yaml, json or binary).  Detected automatically by default.')
+    parser.add_argument('--prune_unused', action='store_true', default=False, help='Leaves out the bitmaps that no animation uses and the '
+        'palettes that no remaining bitmap uses, renumbering the rest.')
+    parser.add_argument('--cache_dir', help='Directory for the incremental build cache.  Inputs whose contents have not changed since the last build '
+        'with the same cache directory are not decoded again.')
+    metrics.AddArguments(parser)
     args = parser.parse_args()
-    base_path = args.input
-    palette_path = os.path.join(base_path, 'palettes')
-    bitmap_path = os.path.join(base_path, 'bitmaps')
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    if args.truecolor and args.palettes_from_bitmaps:
+        parser.error('--truecolor needs the palette files, so it cannot be combined with --palettes_from_bitmaps')
+    if archive.IsArchive(args.input):
+        if args.cache_dir:
+            parser.error('--cache_dir keys on the individual input files, so it cannot be used with an archive')
+        # the archive is memory-mapped and its members are read in place
+        storage = archive.ZipReader(args.input)
+    else:
+        storage = archive.Directory(args.input)
+    recorder = metrics.FromArguments(args, 'art_builder')
+    cache = build_cache.BuildCache(args.cache_dir) if args.cache_dir else None
     with args.prt as prt:
         with args.bmp as bmp:
             prt = prt_file.PRTFile(prt, bmp)
+            prt.metrics = recorder
             print 'Loading bitmaps...'
-            with open(os.path.join(base_path, 'bitmaps.yml'), 'r') as f:
-                bmp_metadata = yaml.load(f.read(), Loader=yaml.CLoader)
+            with recorder.Phase('read_bitmap_metadata') as phase:
+                metadata_format = args.metadata_format or metadata.DetectFormat(storage)
+                bmp_metadata = metadata.ReadBitmapMetadata(storage, metadata_format)
                 num_palettes = bmp_metadata['num_palettes']
                 del bmp_metadata['num_palettes']
-                for k in sorted(bmp_metadata.iterkeys()): 
-                    v = bmp_metadata[k]
-                    bmp = bitmap.Bitmap()
-                    bmp.LoadBMP(os.path.join(bitmap_path, '%d.bmp' % int(k)))
-                    bmp.image_type = v['type']
-                    bmp.palette_id = k if args.palettes_from_bitmaps else v['palette']
-                    prt.bitmaps.append(bmp)
+                phase.bytes = storage.Size(metadata.MetadataName('bitmaps', metadata_format))
+                phase.records = len(bmp_metadata)
+            bmp_jobs = []
+            for k in sorted(bmp_metadata.iterkeys()):
+                v = bmp_metadata[k]
+                bmp_jobs.append(('bitmaps/%d.bmp' % int(k), v['type'], k if args.palettes_from_bitmaps else v['palette']))
+            # The bitmap and palette files are read by the worker pool while the animation metadata is parsed below.  map_async keeps the results in
+            # index order.
+            pool = multiprocessing.pool.ThreadPool(args.jobs)
+            chunksize = max(1, len(bmp_jobs) // (args.jobs * 4))
+            bitmaps = pool.map_async(functools.partial(_LoadBitmap, storage=storage, cache=cache, allow_truecolor=args.truecolor), bmp_jobs, chunksize=chunksize)
             if not args.palettes_from_bitmaps:
                 print 'Loading palettes...'
                 pal_format = palette.PAL_FORMATS[args.palette_format]
-                for i in xrange(num_palettes):
-                    pal = palette.Palette()
-                    pal.LoadPAL(os.path.join(palette_path, '%d.%s' % (i, pal_format[1])), file_format=pal_format[0])
-                    prt.palettes.append(pal)
-            else:
-                for b in prt.bitmaps:
-                    prt.palettes.append(b.palette)
+                pal_jobs = [('palettes/%d.%s' % (i, pal_format[1]), pal_format[0]) for i in xrange(num_palettes)]
+                palettes = pool.map_async(functools.partial(_LoadPalette, storage=storage, cache=cache), pal_jobs, chunksize=chunksize)
+            pool.close()
             print 'Loading animation metadata...'
-            with open(os.path.join(base_path, 'animations.yml'), 'r') as f:
-                metadata = yaml.load(f.read(), Loader=yaml.CLoader)
-                prt.num_optional_entries = metadata['num_optional_entries']
-                del metadata['num_optional_entries']
-                for k in sorted(metadata.iterkeys()):
-                    prt.animations.append(metadata[k])
+            with recorder.Phase('read_animation_metadata') as phase:
+                anim_filename = metadata.MetadataName('animations', metadata_format)
+                # the cached segment is the encoded animation table, which is written out as-is (so it can't be used when the bitmaps get
+                # renumbered)
+                encoded_animations = None
+                segment = cache.Lookup(storage.Path(anim_filename), 'animations') if cache and not args.prune_unused else None
+                if segment is not None:
+                    low, high, encoded_animations = build_cache.DecodeAnimations(segment)
+                    if low < 0 or high >= len(bmp_jobs):
+                        # dangling bitmap IDs; read the metadata after all, so that validation can say where they are
+                        encoded_animations = None
+                if encoded_animations is None:
+                    try:
+                        prt.num_optional_entries, prt.animations = metadata.ReadAnimationMetadata(storage, metadata_format)
+                    except prt_file.PRTWriteError as e:
+                        print 'Invalid references:\n%s' % e
+                        sys.exit(1)
+                phase.bytes = storage.Size(anim_filename)
+                phase.records = len(prt.animations) + prt.animations.NumFrames() + prt.animations.NumSubframes()
             print 'Loading extra data...'
-            with open(os.path.join(base_path, 'extra.dat'), 'rb') as f:
-                prt.extra_data.extend(f.read())
+            with recorder.Phase('read_extra_data') as phase:
+                prt.extra_data.extend(storage.Read('extra.dat'))
+                phase.bytes = len(prt.extra_data)
+            # only covers the time spent waiting for the image files once the metadata has been read
+            with recorder.Phase('read_images') as phase:
+                prt.bitmaps = bitmaps.get()
+                if not args.palettes_from_bitmaps:
+                    prt.palettes = palettes.get()
+                pool.join()
+                phase.records = len(bmp_jobs) + (0 if args.palettes_from_bitmaps else num_palettes)
+            if args.palettes_from_bitmaps:
+                with recorder.Phase('intern_palettes') as phase:
+                    prt.palettes = palette_interning.InternPalettes(prt.bitmaps, merge_unused=args.merge_palettes)
+                    phase.records = len(prt.bitmaps)
+                print 'Interned %d bitmap palettes into %d palettes.' % (len(prt.bitmaps), len(prt.palettes))
+            truecolor = [(i, b) for i, b in enumerate(prt.bitmaps) if b.rgb is not None]
+            if truecolor:
+                print 'Mapping %d truecolor bitmaps onto their palettes...' % len(truecolor)
+                with recorder.Phase('quantize') as phase:
+                    luts = {}
+                    for i, b in truecolor:
+                        if b.palette_id < 0 or b.palette_id >= len(prt.palettes):
+                            raise quantize.QuantizeError('bitmap %d: palette_id %d out of range' % (i, b.palette_id))
+                        if b.palette_id not in luts:
+                            luts[b.palette_id] = quantize.PaletteLUT(prt.palettes[b.palette_id], cache_dir=args.lut_cache_dir)
+                        quantize.QuantizeBitmap(b, luts[b.palette_id], dither=args.dither)
+                        phase.bytes = phase.bytes + len(b.data)
+                    for lut in luts.itervalues():
+                        lut.Save()
+                    phase.records = len(truecolor)
+            if args.prune_unused:
+                with recorder.Phase('prune_unused') as phase:
+                    num_bitmaps = len(prt.bitmaps)
+                    num_palettes = len(prt.palettes)
+                    try:
+                        prt.PruneUnused()
+                    except prt_file.PRTWriteError as e:
+                        print 'Invalid references:\n%s' % e
+                        sys.exit(1)
+                    phase.records = num_bitmaps + prt.animations.NumSubframes()
+                print 'Pruned %d unused bitmaps and %d unused palettes.' % (num_bitmaps - len(prt.bitmaps), num_palettes - len(prt.palettes))
             print 'Writing op2_art data...'
-            prt.Write()
+            prt.dedup_bitmaps = args.dedup_bitmaps
+            with recorder.Phase('write'):
+                try:
+                    prt.Write(encoded_animations=encoded_animations)
+                except prt_file.PRTWriteError as e:
+                    print 'Invalid references:\n%s' % e
+                    sys.exit(1)
+            if args.dedup_bitmaps:
+                print 'Bitmap deduplication saved %d bytes.' % prt.dedup_bytes_saved
+            if cache:
+                with recorder.Phase('save_cache'):
+                    # only now that the animation table has passed validation and been written; a cached table is trusted apart from its
+                    # bitmap ID range
+                    if encoded_animations is None and not args.prune_unused:
+                        cache.Store(storage.Path(anim_filename), 'animations', build_cache.EncodeAnimations(prt))
+                    cache.Save()
+                print 'Build cache: %d hits, %d misses' % (cache.hits, cache.misses)
+            storage.Close()
+            metrics.Report(recorder, args)
             print 'Success!'
 
 if __name__ == '__main__':
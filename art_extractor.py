@@ -2,66 +2,125 @@
 """Main program to decompile OP2_ART .prt and .bmp files into human-readable structures."""
 
 import argparse
+import cStringIO
+import functools
+import multiprocessing.pool
 import os
 import sys
-import yaml
 
+import archive
 import bitmap
+import metadata
+import metrics
 import palette
 import prt_file
+import snapshot_cache
+
+def _Export(job, storage):
+    """Runs one (function, filename, kwargs) export job, writing the file with function(open file, **kwargs) to storage (see archive), or into
+    memory if storage is None.  Returns the filename, the data written to memory (None when writing to storage) and an error message (or None on
+    success)."""
+    func, filename, kwargs = job
+    try:
+        if storage is None:
+            f = cStringIO.StringIO()
+            func(f, **kwargs)
+            return filename, f.getvalue(), None
+        with storage.Open(filename, 'wb') as f:
+            func(f, **kwargs)
+    except Exception as e:
+        return filename, None, str(e) or e.__class__.__name__
+    return filename, None, None
 
 def main():
     parser = argparse.ArgumentParser(description='Decompiles OP2_ART assets into human-readable formats.')
     parser.add_argument('prt', type=argparse.FileType('rb'), help='Path to input op2_art.prt.')
     parser.add_argument('bmp', type=argparse.FileType('rb'), help='Path to input op2_art.bmp.')
-    parser.add_argument('output', help='Output directory to write to.  Will be created if it doesn\'t exist.')
+    parser.add_argument('output', help='Output directory to write to.  Will be created if it doesn\'t exist.  With --archive, the archive file to '
+        'write.')
     parser.add_argument('--palette_format', default='act', choices=palette.PAL_FORMATS.keys(), help='Palette format to dump.  Choices are pal (Microsoft .pal '
         'format), text (.pal text format supported by Paint Shop Pro), or act (Photoshop .act color table, default).')
+    parser.add_argument('--mmap', action='store_true', default=False, help='Memory-maps op2_art.bmp instead of reading a copy of every bitmap into '
+        'memory.')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of worker threads used to write the bitmap and palette files (default 1).')
+    parser.add_argument('--metadata_format', default='yaml', choices=sorted(metadata.METADATA_FORMATS.keys()), help='Format of the bitmap and '
+        'animation metadata files.  Choices are yaml (human-editable, default), json (much faster to read and write) or binary (fastest, not '
+        'human-readable).')
+    parser.add_argument('--archive', action='store_true', default=False, help='Writes everything into a single uncompressed zip archive instead of '
+        'a directory of separate files.  art_builder.py reads these directly.')
+    snapshot_cache.AddArguments(parser)
+    metrics.AddArguments(parser)
     args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    recorder = metrics.FromArguments(args, 'art_extractor')
     with args.prt as prt:
         with args.bmp as bmp:
             prt = prt_file.PRTFile(prt, bmp)
+            prt.metrics = recorder
             print 'Loading op2_art data...'
-            prt.Load()
-    print 'Dumping palettes...'
-    base_path = args.output
-    try:
-        os.mkdir(base_path)
-    except OSError:
-        pass
-    palette_path = os.path.join(base_path, 'palettes')
-    bitmap_path = os.path.join(base_path, 'bitmaps')
-    try:
-        os.mkdir(palette_path)
-    except OSError:
-        pass
+            with recorder.Phase('load'):
+                prt.Load(mmap_bitmaps=args.mmap, snapshot_cache=snapshot_cache.FromArguments(args))
+    if args.archive:
+        storage = archive.ZipWriter(args.output)
+    else:
+        storage = archive.Directory(args.output)
+        for path in [args.output, os.path.join(args.output, 'palettes'), os.path.join(args.output, 'bitmaps')]:
+            try:
+                os.mkdir(path)
+            except OSError:
+                pass
     pal_format = palette.PAL_FORMATS[args.palette_format]
+    jobs = []
     for i, p in enumerate(prt.palettes):
-        p.WritePAL(os.path.join(palette_path, '%d.%s' % (i, pal_format[1])), file_format=pal_format[0])
-    print 'Dumping bitmaps...'
-    try:
-        os.mkdir(bitmap_path)
-    except OSError:
-        pass
+        jobs.append((p.WritePALToOpenFile, 'palettes/%d.%s' % (i, pal_format[1]), {'file_format': pal_format[0]}))
     bmp_metadata = {'num_palettes': len(prt.palettes)}
     for i, b in enumerate(prt.bitmaps):
         bmp_metadata[i] = {
             'type': b.image_type,
             'palette': b.palette_id
         }
-        b.WriteBMP(os.path.join(bitmap_path, '%d.bmp' % i))
+        jobs.append((b.WriteBMPToOpenFile, 'bitmaps/%d.bmp' % i, {}))
+    print 'Dumping palettes and bitmaps...'
+    # The image files are written by the worker pool while the metadata is dumped below.  Archive members end up in the order they are added, so
+    # for those the workers only write the files into memory, and they are added to the archive in job order afterwards.
+    pool = multiprocessing.pool.ThreadPool(args.jobs)
+    results = pool.map_async(functools.partial(_Export, storage=None if args.archive else storage), jobs,
+        chunksize=max(1, len(jobs) // (args.jobs * 4)))
+    pool.close()
     print 'Dumping bitmap metadata...'
-    with open(os.path.join(base_path, 'bitmaps.yml'), 'w') as f:
-        f.write(yaml.dump(bmp_metadata, Dumper=yaml.CDumper))
+    with recorder.Phase('write_bitmap_metadata') as phase:
+        metadata.WriteBitmapMetadata(storage, bmp_metadata, args.metadata_format)
+        phase.bytes = storage.Size(metadata.MetadataName('bitmaps', args.metadata_format))
+        phase.records = len(prt.bitmaps)
     print 'Dumping animation metadata...'
-    with open(os.path.join(base_path, 'animations.yml'), 'w') as f:
-        metadata = dict(enumerate(prt.animations))
-        # since we don't know where to put this at the moment...
-        metadata['num_optional_entries'] = prt.num_optional_entries
-        f.write(yaml.dump(metadata, Dumper=yaml.CDumper))
+    with recorder.Phase('write_animation_metadata') as phase:
+        metadata.WriteAnimationMetadata(storage, prt.IterAnimations(), prt.num_optional_entries, args.metadata_format)
+        phase.bytes = storage.Size(metadata.MetadataName('animations', args.metadata_format))
+        phase.records = len(prt.animations) + prt.animations.NumFrames() + prt.animations.NumSubframes()
     print 'Dumping extra data...'
-    with open(os.path.join(base_path, 'extra.dat'), 'wb') as f:
-        f.write(prt.extra_data)
+    with recorder.Phase('write_extra_data') as phase:
+        with storage.Open('extra.dat', 'wb') as f:
+            f.write(prt.extra_data)
+        phase.bytes = len(prt.extra_data)
+    # map_async keeps the results in job order, so errors are reported deterministically.  This phase only covers the time spent waiting for the
+    # image files once the metadata has been written.
+    with recorder.Phase('write_images') as phase:
+        errors = []
+        for filename, data, error in results.get():
+            if error is not None:
+                errors.append((filename, error))
+            elif data is not None:
+                storage.Write(filename, data)
+        pool.join()
+        phase.records = len(jobs)
+    storage.Close()
+    metrics.Report(recorder, args)
+    if errors:
+        for filename, error in errors:
+            print 'Error writing %s: %s' % (filename, error)
+        print 'Failed to write %d of %d files.' % (len(errors), len(jobs))
+        sys.exit(1)
     print 'Success!'
 
 if __name__ == '__main__':
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+"""Converts the bitmap and animation metadata in an extracted art directory between the YAML, JSON and binary formats."""
+
+import argparse
+import os
+import sys
+
+import metadata
+
+def main():
+    parser = argparse.ArgumentParser(description='Converts OP2_ART metadata files between formats.')
+    parser.add_argument('input', help='Directory containing the extracted art (as written by art_extractor.py).')
+    parser.add_argument('format', choices=sorted(metadata.METADATA_FORMATS.keys()), help='Format to convert the metadata to.')
+    parser.add_argument('--from', dest='from_format', choices=sorted(metadata.METADATA_FORMATS.keys()), help='Format to convert from.  Detected '
+        'automatically by default.')
+    parser.add_argument('--keep', action='store_true', default=False, help='Keeps the metadata files in the old format.  The builder then needs '
+        '--metadata_format to choose between them.')
+    args = parser.parse_args()
+    from_format = args.from_format or metadata.DetectFormat(args.input)
+    if from_format == args.format:
+        print 'Metadata is already in %s format.' % args.format
+        sys.exit(0)
+    print 'Converting bitmap metadata...'
+    metadata.WriteBitmapMetadata(args.input, metadata.ReadBitmapMetadata(args.input, from_format), args.format)
+    print 'Converting animation metadata...'
+    if from_format == 'binary' or args.format == 'binary':
+        num_optional_entries, animations = metadata.ReadAnimationMetadata(args.input, from_format)
+        metadata.WriteAnimationMetadata(args.input, animations, num_optional_entries, args.format)
+    else:
+        # YAML <-> JSON is converted one animation at a time, as long as the file is laid out the way the extractor writes it
+        reader = metadata.AnimationMetadataReader(args.input, from_format)
+        try:
+            if reader.num_optional_entries is None:
+                raise metadata.MetadataLoadError('num_optional_entries not found up front')
+            metadata.WriteAnimationMetadata(args.input, reader, reader.num_optional_entries, args.format)
+        except metadata.MetadataLoadError:
+            num_optional_entries, animations = metadata.ReadAnimationMetadata(args.input, from_format)
+            metadata.WriteAnimationMetadata(args.input, animations, num_optional_entries, args.format)
+    if args.keep:
+        print 'Success!  (The %s files have been kept; build with --metadata_format to choose between the formats.)' % from_format
+        return
+    # only once both files have been converted, so a failed conversion leaves the original metadata usable
+    for name in ['bitmaps', 'animations']:
+        os.remove(metadata.MetadataPath(args.input, name, from_format))
+    print 'Success!'
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+"""Main program to replace single bitmaps or animations in OP2_ART .prt and .bmp files, without rebuilding them."""
+
+import argparse
+import sys
+
+import yaml
+
+import bitmap
+import prt_file
+
+def main():
+    parser = argparse.ArgumentParser(description='Replaces bitmaps and animations in OP2_ART files in place.')
+    parser.add_argument('prt', type=argparse.FileType('r+b'), help='Path to op2_art.prt.  Will be modified.')
+    parser.add_argument('bmp', type=argparse.FileType('r+b'), help='Path to op2_art.bmp.  Will be modified.')
+    parser.add_argument('--bitmap', nargs=2, action='append', default=[], metavar=('ID', 'FILE'), help='Replaces bitmap ID with a BMP file.  The '
+        'bitmap keeps its image type and palette, and the file has to match them (8bpp, or 1bpp for image types 4 and 5).  May be repeated.')
+    parser.add_argument('--animation', nargs=2, action='append', default=[], metavar=('ID', 'FILE'), help='Replaces animation ID with a YAML or '
+        'JSON file holding one animation, in the same form as the entries in the extractor\'s animations.yml.  May be repeated.')
+    parser.add_argument('--index', help='Sidecar file for the PRT offset index (see PRTFile.Open).  Kept up to date by the patches.')
+    args = parser.parse_args()
+    if not args.bitmap and not args.animation:
+        parser.error('nothing to patch; use --bitmap and/or --animation')
+    prt = prt_file.PRTFile(args.prt, args.bmp)
+    prt.Open(args.index, writable=True)
+    errors = []
+    for kind, patches in (('bitmap', args.bitmap), ('animation', args.animation)):
+        for i, filename in patches:
+            try:
+                i = int(i)
+                if kind == 'bitmap':
+                    old = prt.GetBitmap(i)
+                    bmp = bitmap.Bitmap()
+                    bmp.LoadBMP(filename)
+                    bmp.image_type = old.image_type
+                    bmp.palette_id = old.palette_id
+                    if len(bmp.data) != bmp.Stride() * bmp.height:
+                        raise bitmap.BitmapLoadError('pixel data does not match image type %d (%dbpp)' % (bmp.image_type, bmp.BitsPerPixel()))
+                    in_place = prt.ReplaceBitmap(i, bmp)
+                else:
+                    with open(filename, 'r') as f:
+                        anim = yaml.load(f, Loader=yaml.CLoader)
+                    in_place = prt.ReplaceAnimation(i, anim)
+            except Exception as e:
+                errors.append('%s %s (%s): %s' % (kind, i, filename, str(e) or e.__class__.__name__))
+                continue
+            print 'Replaced %s %d %s' % (kind, i, 'in place' if in_place else '(moved the rest of the file)')
+    if errors:
+        for error in errors:
+            print 'Error patching %s' % error
+        sys.exit(1)
+    print 'Success!'
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""Main program to render the animations in OP2_ART .prt and .bmp files to PNG images."""
+
+import argparse
+import multiprocessing
+import multiprocessing.pool
+import os
+import sys
+
+import prt_file
+import render
+import snapshot_cache
+
+# The renderer, the (animation ID, animation) pairs to render and the parsed arguments, set up by main.  Worker processes are forked once these
+# are set, so they share them without pickling anything.
+_renderer = None
+_animations = None
+_args = None
+
+def _RenderAnimation(job):
+    """Renders the animation at index job of _animations, returning the animation ID and an error message (or None on success)."""
+    renderer = _renderer
+    i, anim = _animations[job]
+    args = _args
+    try:
+        if args.sheet:
+            width, height, pixels = renderer.RenderSheet(anim, columns=args.columns)
+            render.WritePNG(os.path.join(args.output, '%d.png' % i), width, height, pixels, compression=args.compression)
+        else:
+            path = os.path.join(args.output, str(i))
+            try:
+                os.mkdir(path)
+            except OSError:
+                pass
+            width, height = renderer.FrameSize(anim)
+            for j in xrange(len(anim.frames)):
+                render.WritePNG(os.path.join(path, '%d.png' % j), width, height, renderer.RenderFrame(anim, j), compression=args.compression)
+    except Exception as e:
+        return i, str(e) or e.__class__.__name__
+    return i, None
+
+def main():
+    parser = argparse.ArgumentParser(description='Renders OP2_ART animations to PNG images.')
+    parser.add_argument('prt', type=argparse.FileType('rb'), help='Path to input op2_art.prt.')
+    parser.add_argument('bmp', type=argparse.FileType('rb'), help='Path to input op2_art.bmp.')
+    parser.add_argument('output', help='Output directory to write to.  Will be created if it doesn\'t exist.')
+    parser.add_argument('--animations', type=int, nargs='+', help='IDs of the animations to render (default all).  Only these animations and the '
+        'bitmaps they use are decoded.')
+    parser.add_argument('--sheet', action='store_true', default=False, help='Writes one sprite sheet per animation (<output>/<id>.png) instead of '
+        'one image per frame (<output>/<id>/<frame>.png).')
+    parser.add_argument('--columns', type=int, default=0, help='Number of frames per row in sprite sheets (default all frames in one row).')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of worker processes used to render the animations (default 1).  Where '
+        'processes can\'t be forked (Windows), threads are used instead, which only overlap the PNG compression and file writes.')
+    parser.add_argument('--compression', type=int, default=6, choices=range(10), help='zlib compression level of the PNG files (default 6).')
+    snapshot_cache.AddArguments(parser)
+    args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    if args.columns < 0:
+        parser.error('--columns cannot be negative')
+    prt = prt_file.PRTFile(args.prt, args.bmp)
+    if args.animations:
+        # random access: only decode what the requested animations need
+        prt.Open()
+        try:
+            animations = [(i, prt.GetAnimation(i)) for i in args.animations]
+        except IndexError as e:
+            parser.error(str(e))
+        renderer = render.Renderer(prt.GetBitmap)
+    else:
+        print 'Loading op2_art data...'
+        prt.Load(mmap_bitmaps=True, snapshot_cache=snapshot_cache.FromArguments(args))
+        animations = list(enumerate(prt.animations))
+        renderer = render.Renderer(prt.bitmaps.__getitem__)
+    try:
+        os.mkdir(args.output)
+    except OSError:
+        pass
+    print 'Rendering %d animations...' % len(animations)
+    global _renderer, _animations, _args
+    _renderer = renderer
+    _animations = animations
+    _args = args
+    if args.jobs > 1 and hasattr(os, 'fork'):
+        # compositing is pure python and holds the GIL, so only separate processes render in parallel
+        pool = multiprocessing.Pool(args.jobs)
+    else:
+        pool = multiprocessing.pool.ThreadPool(args.jobs)
+    jobs = range(len(animations))
+    results = pool.map_async(_RenderAnimation, jobs, chunksize=max(1, len(jobs) // (args.jobs * 4)))
+    pool.close()
+    # map_async keeps the results in job order, so errors are reported deterministically
+    errors = [(i, error) for i, error in results.get() if error is not None]
+    pool.join()
+    if errors:
+        for i, error in errors:
+            print 'Error rendering animation %d: %s' % (i, error)
+        print 'Failed to render %d of %d animations.' % (len(errors), len(jobs))
+        sys.exit(1)
+    print 'Success!'
+
+if __name__ == '__main__':
+    main()
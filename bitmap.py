@@ -2,60 +2,221 @@
 BMPs are documented here: http://en.wikipedia.org/wiki/BMP_file_format#mediaviewer/File:BMPfileFormat.png
 """
 
+import binascii
+import string
 import struct
 
 import palette
 
 BITMAPFILEHEADER = struct.Struct('<2s I hh I')
 BITMAPINFOHEADER = struct.Struct('<IiihhIIiiII')
+# sizes of BITMAPV4HEADER and BITMAPV5HEADER, which extend BITMAPINFOHEADER and are often written for truecolor images
+BITMAPV4HEADER_SIZE = 108
+BITMAPV5HEADER_SIZE = 124
+# compression values
+BI_RGB = 0
+BI_BITFIELDS = 3
+# red, green and blue masks of BI_BITFIELDS bitmaps, which follow BITMAPINFOHEADER (and are the next fields of the V4/V5 headers)
+BITFIELDS_MASKS = struct.Struct('<3I')
+BGRA_MASKS = (0x00ff0000, 0x0000ff00, 0x000000ff)
+# alpha mask, which follows the others in the V4/V5 headers
+BITFIELDS_ALPHA_MASK = struct.Struct('<I')
+BGRA_ALPHA_MASK = 0xff000000
+
+# each byte of 1bpp data unpacked into 8 bytes of 0/1, most significant bit first
+_UNPACK_BITS = [''.join(chr((b >> (7 - i)) & 1) for i in xrange(8)) for b in xrange(256)]
+_BIT_CHARS = string.maketrans('\x00\x01', '01')
 
 class BitmapLoadError(Exception):
     pass
 
+def RowStride(width, bpp):
+    """Returns the size in bytes of a row of pixels.  Rows are padded to a multiple of 4 bytes, in BMP files as well as in OP2_ART."""
+    return (width * bpp + 31) // 32 * 4
+
+def UnpackBits(data, width, height):
+    """Returns packed 1bpp pixel data as a bytearray of one 0/1 byte per pixel (width * height bytes, no row padding)."""
+    stride = RowStride(width, 1)
+    bits = ''.join(map(_UNPACK_BITS.__getitem__, bytearray(buffer(data, 0, stride * height))))
+    if stride * 8 != width:
+        bits = ''.join(bits[y * stride * 8:y * stride * 8 + width] for y in xrange(height))
+    return bytearray(bits)
+
+def PackBits(indices, width, height):
+    """Inverse of UnpackBits: packs one 0/1 byte per pixel into padded 1bpp rows."""
+    indices = str(indices)
+    if indices.translate(None, '\x00\x01'):
+        raise ValueError('1bpp pixels can only use palette indices 0 and 1')
+    pad = '\x00' * (RowStride(width, 1) * 8 - width)
+    # the rows as one string of binary digits, converted to bytes in a single step (a multiple of 32 bits, so no partial hex digits)
+    bits = ''.join(indices[y * width:(y + 1) * width] + pad for y in xrange(height)).translate(_BIT_CHARS)
+    if not bits:
+        return bytearray()
+    return bytearray(binascii.unhexlify('%0*x' % (len(bits) // 4, int(bits, 2))))
+
 class Bitmap(object):
     def __init__(self):
         self.palette = palette.Palette()
         self.width = 0
         self.height = 0
-        self.data = bytearray()
+        self._data = bytearray()
         self.image_type = 0
         self.palette_id = 0
         self.offset = 0
+        # Truecolor pixels (r, g, b; top-down, unpadded) of an image loaded with LoadBMP(allow_truecolor=True) that still needs to be mapped onto a
+        # palette (see quantize.QuantizeBitmap)
+        self.rgb = None
+        # Alpha of each of those pixels (top-down, unpadded), if the image has an alpha channel; transparent pixels are mapped to palette index 0
+        self.alpha = None
+
+    @property
+    def data(self):
+        """Raw pixel data.  May be a read-only view into a memory-mapped file; use MutableData() to modify it."""
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+
+    def MutableData(self):
+        """Returns the pixel data as a bytearray, copying it out of any read-only view first (copy-on-write)."""
+        if not isinstance(self._data, bytearray):
+            self._data = bytearray(self._data)
+        return self._data
+
+    def BitsPerPixel(self):
+        """Returns the pixel size of the image type: image types 4 and 5 are 1bpp, all others 8bpp."""
+        return 1 if self.image_type in [4, 5] else 8
+
+    def Stride(self):
+        """Returns the size in bytes of a row of pixel data."""
+        return RowStride(self.width, self.BitsPerPixel())
+
+    def Indices(self):
+        """Returns the palette index of every pixel, as a bytearray of width * height bytes (top-down rows with no padding)."""
+        if self.BitsPerPixel() == 1:
+            return UnpackBits(self._data, self.width, self.height)
+        stride = self.Stride()
+        data = str(self._data)
+        if stride == self.width:
+            return bytearray(data[:stride * self.height])
+        return bytearray(''.join(data[y * stride:y * stride + self.width] for y in xrange(self.height)))
+
+    def SetIndices(self, indices):
+        """Inverse of Indices: stores width * height palette indices as the pixel data, packing and padding the rows for the image type."""
+        if len(indices) != self.width * self.height:
+            raise ValueError('expected %d pixels, got %d' % (self.width * self.height, len(indices)))
+        if self.BitsPerPixel() == 1:
+            self._data = PackBits(indices, self.width, self.height)
+            return
+        indices = str(indices)
+        pad = '\x00' * (self.Stride() - self.width)
+        self._data = bytearray(''.join(indices[y * self.width:(y + 1) * self.width] + pad for y in xrange(self.height)))
 
-    def LoadBMP(self, filename):
-        """Reads the image from a standard .BMP file."""
+    def UsedColors(self):
+        """Returns the set of palette indices used by the bitmap's pixels (any row padding included)."""
+        if self.image_type in [4, 5]:
+            # 1bpp: every pixel is index 0 or 1
+            return frozenset([0, 1])
+        return frozenset(ord(c) for c in set(str(self._data)))
+
+    def _LoadTruecolor(self, f, info_size, data_offset, bpp, compression):
+        """Reads 24- or 32-bpp pixel data into rgb (and alpha).  The file has to be positioned just after the BITMAPINFOHEADER fields."""
+        alpha_mask = BGRA_ALPHA_MASK if bpp == 32 else 0
+        if compression == BI_BITFIELDS and bpp == 32:
+            # only the usual layout, with each channel in its own byte like BI_RGB
+            masks = BITFIELDS_MASKS.unpack(f.read(BITFIELDS_MASKS.size))
+            if masks != BGRA_MASKS:
+                raise BitmapLoadError('unsupported BI_BITFIELDS masks (%s)' % ', '.join('0x%08x' % m for m in masks))
+            if info_size >= BITMAPV4HEADER_SIZE:
+                alpha_mask, = BITFIELDS_ALPHA_MASK.unpack(f.read(BITFIELDS_ALPHA_MASK.size))
+                if alpha_mask not in [0, BGRA_ALPHA_MASK]:
+                    raise BitmapLoadError('unsupported BI_BITFIELDS alpha mask (0x%08x)' % alpha_mask)
+        elif compression != BI_RGB:
+            raise BitmapLoadError('compressed truecolor bitmaps are not supported')
+        pixel_size = bpp // 8
+        stride = (self.width * pixel_size + 3) & ~3
+        # Unlike the paletted bitmaps, these come straight from image editors, so bottom-up is accepted too
+        top_down = self.height < 0
+        self.height = abs(self.height)
+        f.seek(data_offset)
+        raw = f.read(stride * self.height)
+        if len(raw) != stride * self.height:
+            raise BitmapLoadError('ran out of pixel data')
+        row_size = self.width * 3
+        self.rgb = bytearray(row_size * self.height)
+        alpha = bytearray(self.width * self.height) if alpha_mask else None
+        for y in xrange(self.height):
+            src = (y if top_down else self.height - 1 - y) * stride
+            row = raw[src:src + self.width * pixel_size]
+            dst = y * row_size
+            # BMP pixels are stored as b, g, r(, a)
+            self.rgb[dst:dst + row_size:3] = row[2::pixel_size]
+            self.rgb[dst + 1:dst + row_size:3] = row[1::pixel_size]
+            self.rgb[dst + 2:dst + row_size:3] = row[0::pixel_size]
+            if alpha is not None:
+                alpha[y * self.width:(y + 1) * self.width] = row[3::pixel_size]
+        # plenty of editors write 32-bpp images without transparency with the fourth byte left 0
+        self.alpha = alpha if alpha is not None and any(alpha) else None
+        self.data = bytearray()
+
+    def LoadBMP(self, filename, allow_truecolor=False):
+        """Reads the image from a standard .BMP file.
+
+        If allow_truecolor is set, 24- and 32-bpp images are accepted too, including those with BITMAPV4HEADER/BITMAPV5HEADER headers or
+        BI_BITFIELDS pixels in the standard BGRA layout.  Their pixels are stored in rgb (and the alpha channel of 32-bpp images in alpha) and
+        have to be mapped onto a palette (see quantize.QuantizeBitmap) before the bitmap can be written.
+        """
         with open(filename, 'rb') as f:
-            sig, file_size, _, _, data_offset = BITMAPFILEHEADER.unpack(f.read(14))
-            if sig != 'BM':
-                raise BitmapLoadError('not a valid windows BMP file')
-            # Height is negative, since OP2 stores these in top down (sane) manner
-            info_size, self.width, self.height, _, bpp, _, _, _, _, pal_len, _ = BITMAPINFOHEADER.unpack(f.read(40))
-            if info_size != 40:
-                raise BitmapLoadError('cannot handle bitmaps that do not use BITMAPINFOHEADER')
-            if pal_len != 256:
-                raise BitmapLoadError('unexpected palette length (got %d, expected 256)' % pal_len)
-            if bpp not in [1, 8]:
-                raise BitmapLoadError('only 1- and 8-bpp bitmaps are supported by the game')
-            if self.height > 0:
-                raise BitmapLoadError('only top-down bitmaps (height < 0) are supported')
-            self.height = -self.height
-            self.palette.ReadColorTable(f, num_colors=pal_len)
-            f.seek(data_offset)
-            padded_width = (self.width + 3) & ~3
-            self.data = bytearray(f.read(padded_width * self.height))
+            self.LoadBMPFromOpenFile(f, allow_truecolor=allow_truecolor)
 
-    def WriteBMPToOpenFile(self, f):
-        """Writes the BMP data to an open file handle."""
+    def LoadBMPFromOpenFile(self, f, allow_truecolor=False):
+        """Reads the image from an open file handle (see LoadBMP)."""
+        sig, file_size, _, _, data_offset = BITMAPFILEHEADER.unpack(f.read(14))
+        if sig != 'BM':
+            raise BitmapLoadError('not a valid windows BMP file')
+        # Height is negative, since OP2 stores these in top down (sane) manner
+        info_size, self.width, self.height, _, bpp, compression, _, _, _, pal_len, _ = BITMAPINFOHEADER.unpack(f.read(40))
+        truecolor = allow_truecolor and bpp in [24, 32]
+        if info_size != BITMAPINFOHEADER.size and not (truecolor and info_size in [BITMAPV4HEADER_SIZE, BITMAPV5HEADER_SIZE]):
+            raise BitmapLoadError('cannot handle bitmaps that do not use BITMAPINFOHEADER')
+        if truecolor:
+            self._LoadTruecolor(f, info_size, data_offset, bpp, compression)
+            return
+        if bpp not in [1, 8]:
+            raise BitmapLoadError('only 1- and 8-bpp bitmaps are supported by the game')
+        # 1bpp color tables have 2 entries (0 means the same); older versions of these tools wrote all 256
+        if pal_len not in ([0, 2, 256] if bpp == 1 else [256]):
+            raise BitmapLoadError('unexpected palette length (got %d, expected %s)' % (pal_len, '2' if bpp == 1 else '256'))
+        if self.height > 0:
+            raise BitmapLoadError('only top-down bitmaps (height < 0) are supported')
+        self.height = -self.height
+        num_colors = pal_len or 2
+        self.palette.ReadColorTable(f, num_colors=num_colors)
+        # the PRT palettes always have 256 colors
+        self.palette.data.extend(bytearray((256 - num_colors) * 4))
+        f.seek(data_offset)
+        size = RowStride(self.width, bpp) * self.height
+        self.data = bytearray(f.read(size))
+        if len(self.data) != size:
+            raise BitmapLoadError('ran out of pixel data')
+
+    def WriteBMPHeaderToOpenFile(self, f, data_size):
+        """Writes the BMP headers and color table for data_size bytes of pixel data to an open file handle."""
         # BITMAPINFOHEADER (size, w, h, planes, bpp, compression, image size, h res, v res, num colors, num important colors)
         # Height is negative, since OP2 stores these in top down (sane) manner
-        bpp = 1 if self.image_type in [4, 5] else 8
-        info_header = BITMAPINFOHEADER.pack(40, self.width, -self.height, 1, bpp, 0, 0, 0, 0, len(self.palette.colors), 0)
+        # 1bpp pixels can only refer to the first 2 colors
+        num_colors = 2 if self.BitsPerPixel() == 1 else self.palette.NumColors()
+        info_header = BITMAPINFOHEADER.pack(40, self.width, -self.height, 1, self.BitsPerPixel(), 0, 0, 0, 0, num_colors, 0)
         # BITMAPFILEHEADER (signature, file size, 2x reserved, data offset)
-        file_header = BITMAPFILEHEADER.pack('BM', 14 + len(info_header) + len(self.palette.colors) * 4 + len(self.data), 0, 0, 14 + len(info_header) +
-                len(self.palette.colors) * 4)
+        file_header = BITMAPFILEHEADER.pack('BM', 14 + len(info_header) + num_colors * 4 + data_size, 0, 0, 14 + len(info_header) + num_colors * 4)
         f.write(file_header)
         f.write(info_header)
-        self.palette.WriteColorTable(f)
+        self.palette.WriteColorTable(f, num_colors=num_colors)
+
+    def WriteBMPToOpenFile(self, f):
+        """Writes the BMP data to an open file handle."""
+        self.WriteBMPHeaderToOpenFile(f, len(self.data))
         f.write(self.data)
 
     def WriteBMP(self, filename):
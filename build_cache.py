@@ -0,0 +1,154 @@
+"""Incremental build cache for art_builder.
+
+Each input file (bitmap, palette, animations.yml) is keyed on a hash of its contents, and the cache stores the input already decoded into a byte
+segment that is cheap to turn back into Bitmap/Palette objects or to splice straight into the output PRT.  A manifest records the size, mtime and hash
+of every input seen by the last build, so unchanged files don't even need to be re-hashed.
+"""
+
+import cStringIO
+import errno
+import hashlib
+import json
+import os
+import struct
+import threading
+
+import bitmap
+import palette
+
+MANIFEST = 'manifest.json'
+# Bump whenever the segment encodings change, to invalidate old caches
+VERSION = 4
+
+BITMAP_SEGMENT_HEADER = struct.Struct('<IIH')
+PALETTE_SEGMENT_HEADER = struct.Struct('<H')
+# lowest and highest bitmap ID used by a subframe (0, -1 if there are no subframes)
+ANIMATION_SEGMENT_HEADER = struct.Struct('<hh')
+
+def _HashFile(filename):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(1 << 20)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+def EncodeBitmap(bmp):
+    """Encodes the parts of a bitmap loaded from a .BMP file (size, color table and pixel data) as a cache segment."""
+    f = cStringIO.StringIO()
+    f.write(BITMAP_SEGMENT_HEADER.pack(bmp.width, bmp.height, bmp.palette.NumColors()))
+    bmp.palette.WriteColorTable(f)
+    f.write(bmp.data)
+    return f.getvalue()
+
+def DecodeBitmap(segment):
+    """Inverse of EncodeBitmap."""
+    bmp = bitmap.Bitmap()
+    bmp.width, bmp.height, num_colors = BITMAP_SEGMENT_HEADER.unpack_from(segment)
+    f = cStringIO.StringIO(segment)
+    f.seek(BITMAP_SEGMENT_HEADER.size)
+    bmp.palette.ReadColorTable(f, num_colors=num_colors)
+    bmp.data = bytearray(f.read())
+    return bmp
+
+def EncodePalette(pal):
+    """Encodes a palette as a cache segment."""
+    f = cStringIO.StringIO()
+    f.write(PALETTE_SEGMENT_HEADER.pack(pal.NumColors()))
+    pal.WriteColorTable(f)
+    return f.getvalue()
+
+def DecodePalette(segment):
+    """Inverse of EncodePalette."""
+    pal = palette.Palette()
+    num_colors, = PALETTE_SEGMENT_HEADER.unpack_from(segment)
+    f = cStringIO.StringIO(segment)
+    f.seek(PALETTE_SEGMENT_HEADER.size)
+    pal.ReadColorTable(f, num_colors=num_colors)
+    return pal
+
+def EncodeAnimations(prt):
+    """Encodes the animation table of a prt_file.PRTFile as a cache segment.  The range of bitmap IDs used is kept with it, so that a cached table
+    can be checked against the bitmaps without decoding it; everything else about the table is trusted, so only tables that have passed
+    PRTFile.Validate should be encoded."""
+    ids = prt.animations.subframe_bitmap_id
+    header = ANIMATION_SEGMENT_HEADER.pack(min(ids), max(ids)) if ids else ANIMATION_SEGMENT_HEADER.pack(0, -1)
+    return header + prt.EncodeAnimations()
+
+def DecodeAnimations(segment):
+    """Inverse of EncodeAnimations.  Returns (lowest bitmap ID, highest bitmap ID, animation table encoded as in the PRT)."""
+    low, high = ANIMATION_SEGMENT_HEADER.unpack_from(segment)
+    return low, high, buffer(segment, ANIMATION_SEGMENT_HEADER.size)
+
+class BuildCache(object):
+    """Content-hash keyed store of encoded input segments in cache_dir.  Safe to use from multiple threads."""
+    def __init__(self, cache_dir):
+        self._cache_dir = cache_dir
+        self._lock = threading.Lock()
+        self._old_manifest = {}
+        self._manifest = {}
+        self.hits = 0
+        self.misses = 0
+        try:
+            os.makedirs(cache_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        try:
+            with open(os.path.join(cache_dir, MANIFEST), 'r') as f:
+                manifest = json.load(f)
+            if manifest.get('version') == VERSION:
+                self._old_manifest = manifest['files']
+        except (IOError, ValueError, KeyError):
+            # missing or corrupt manifest: start from scratch
+            pass
+
+    def _SegmentPath(self, kind, digest):
+        return os.path.join(self._cache_dir, '%s-%s.seg' % (kind, digest))
+
+    def _Digest(self, filename):
+        """Returns the content hash of filename, trusting the previous manifest entry if the size and mtime are unchanged."""
+        st = os.stat(filename)
+        key = os.path.abspath(filename)
+        with self._lock:
+            entry = self._old_manifest.get(key)
+        if entry is not None and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime:
+            digest = entry['sha1']
+        else:
+            digest = _HashFile(filename)
+        with self._lock:
+            self._manifest[key] = {'size': st.st_size, 'mtime': st.st_mtime, 'sha1': digest}
+        return digest
+
+    def Lookup(self, filename, kind):
+        """Returns the cached segment of the given kind for filename, or None if its contents have changed (or were never cached)."""
+        try:
+            with open(self._SegmentPath(kind, self._Digest(filename)), 'rb') as f:
+                segment = f.read()
+        except IOError:
+            with self._lock:
+                self.misses = self.misses + 1
+            return None
+        with self._lock:
+            self.hits = self.hits + 1
+        return segment
+
+    def Store(self, filename, kind, segment):
+        """Stores the segment of the given kind for filename's current contents."""
+        path = self._SegmentPath(kind, self._Digest(filename))
+        tmp_path = '%s.%d.tmp' % (path, threading.current_thread().ident)
+        with open(tmp_path, 'wb') as f:
+            f.write(segment)
+        os.rename(tmp_path, path)
+
+    def Save(self):
+        """Writes the manifest and removes segments no longer referenced by any input."""
+        with open(os.path.join(self._cache_dir, MANIFEST + '.tmp'), 'w') as f:
+            json.dump({'version': VERSION, 'files': self._manifest}, f)
+        os.rename(os.path.join(self._cache_dir, MANIFEST + '.tmp'), os.path.join(self._cache_dir, MANIFEST))
+        live = set(entry['sha1'] for entry in self._manifest.itervalues())
+        for name in os.listdir(self._cache_dir):
+            if name.endswith('.seg') and name[:-4].split('-', 1)[-1] not in live:
+                os.remove(os.path.join(self._cache_dir, name))
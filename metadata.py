@@ -0,0 +1,318 @@
+"""Reading/writing the bitmap and animation metadata files in YAML, JSON or a compact binary format.
+
+YAML is the human-editable default.  JSON is handled by the standard library and is much faster to parse; the binary format stores the animation
+table columns as-is (see prt_file.AnimationTable.Serialize) and is the fastest, for when nobody needs to read the metadata.
+
+Wherever a base path is taken, an archive storage object (see archive) may be passed instead of a directory.
+
+The animation metadata is written and read one animation (or a small batch of them) at a time, so the size of the animation table doesn't
+multiply the memory needed for its text and parsed form.
+"""
+
+import array
+import itertools
+import json
+import os
+import re
+import struct
+import sys
+import yaml
+
+import archive
+import prt_file
+
+# format name: file extension
+METADATA_FORMATS = {
+    'yaml': 'yml',
+    'json': 'json',
+    'binary': 'bin',
+}
+
+BINARY_HEADER = struct.Struct('<4s I')
+BINARY_SIGNATURE = 'OP2M'
+BINARY_VERSION = 1
+
+# animations dumped/parsed per YAML call
+YAML_BATCH_SIZE = 64
+# the first line of a streamed JSON animation file; after it comes one animation per line
+JSON_STREAM_HEADER = re.compile(r'^\{"num_optional_entries": (\d+), "animations": \[$')
+YAML_NUM_OPTIONAL_ENTRIES = re.compile(r'^num_optional_entries: (\d+)\s*$', re.M)
+# how much of the end of a YAML file is searched for num_optional_entries
+YAML_TAIL_SIZE = 4096
+
+class MetadataLoadError(Exception):
+    pass
+
+def MetadataName(name, fmt):
+    """Returns the file name of metadata file name ('bitmaps' or 'animations') in the given format."""
+    return '%s.%s' % (name, METADATA_FORMATS[fmt])
+
+def MetadataPath(base_path, name, fmt):
+    """Returns the path of metadata file name ('bitmaps' or 'animations') in the given format."""
+    return os.path.join(base_path, MetadataName(name, fmt))
+
+def _Storage(base_path):
+    return archive.Directory(base_path) if isinstance(base_path, basestring) else base_path
+
+def DetectFormat(base_path):
+    """Returns the format of the metadata files in base_path."""
+    storage = _Storage(base_path)
+    found = [fmt for fmt in sorted(METADATA_FORMATS) if storage.Exists(MetadataName('bitmaps', fmt))]
+    if not found:
+        raise MetadataLoadError('no bitmap metadata found in %s' % base_path)
+    if len(found) > 1:
+        raise MetadataLoadError('metadata found in more than one format (%s); use --metadata_format to choose' % ', '.join(found))
+    return found[0]
+
+def _ReadBinaryHeader(data, filename):
+    if len(data) < BINARY_HEADER.size:
+        raise MetadataLoadError('%s: file too short' % filename)
+    sig, ver = BINARY_HEADER.unpack_from(data)
+    if sig != BINARY_SIGNATURE:
+        raise MetadataLoadError('%s: not a binary metadata file' % filename)
+    if ver != BINARY_VERSION:
+        raise MetadataLoadError('%s: unsupported version %d' % (filename, ver))
+    return BINARY_HEADER.size
+
+def WriteBitmapMetadata(base_path, metadata, fmt):
+    """Writes the bitmap metadata (num_palettes plus a mapping of bitmap ID to type and palette) in the given format."""
+    storage = _Storage(base_path)
+    filename = MetadataName('bitmaps', fmt)
+    if fmt == 'yaml':
+        with storage.Open(filename, 'w') as f:
+            f.write(yaml.dump(metadata, Dumper=yaml.CDumper))
+    elif fmt == 'json':
+        with storage.Open(filename, 'w') as f:
+            json.dump(metadata, f)
+    elif fmt == 'binary':
+        ids = sorted(k for k in metadata if k != 'num_palettes')
+        types = array.array('h', [metadata[k]['type'] for k in ids])
+        palettes = array.array('h', [metadata[k]['palette'] for k in ids])
+        if sys.byteorder == 'big':
+            types.byteswap()
+            palettes.byteswap()
+        with storage.Open(filename, 'wb') as f:
+            f.write(BINARY_HEADER.pack(BINARY_SIGNATURE, BINARY_VERSION))
+            f.write(struct.pack('<II', metadata['num_palettes'], len(ids)))
+            f.write(types.tostring())
+            f.write(palettes.tostring())
+    else:
+        raise ValueError('invalid format')
+
+def ReadBitmapMetadata(base_path, fmt):
+    """Reads the bitmap metadata written by WriteBitmapMetadata.  Bitmap IDs are always returned as ints."""
+    filename = MetadataName('bitmaps', fmt)
+    data = _Storage(base_path).Read(filename)
+    if fmt == 'yaml':
+        return yaml.load(str(data), Loader=yaml.CLoader)
+    elif fmt == 'json':
+        metadata = json.loads(str(data))
+        # JSON object keys are always strings
+        return dict((k if k == 'num_palettes' else int(k), v) for k, v in metadata.iteritems())
+    elif fmt == 'binary':
+        offset = _ReadBinaryHeader(data, filename)
+        num_palettes, num_bitmaps = struct.unpack_from('<II', data, offset)
+        offset = offset + 8
+        if len(data) != offset + num_bitmaps * 4:
+            raise MetadataLoadError('%s: wrong size for %d bitmaps' % (filename, num_bitmaps))
+        types = array.array('h')
+        types.fromstring(buffer(data, offset, num_bitmaps * 2))
+        palettes = array.array('h')
+        palettes.fromstring(buffer(data, offset + num_bitmaps * 2, num_bitmaps * 2))
+        if sys.byteorder == 'big':
+            types.byteswap()
+            palettes.byteswap()
+        metadata = {'num_palettes': num_palettes}
+        for i in xrange(num_bitmaps):
+            metadata[i] = {'type': types[i], 'palette': palettes[i]}
+        return metadata
+    else:
+        raise ValueError('invalid format')
+
+def _AnimationDict(anim):
+    """Returns an animation view or dict as a dict in the form ToDict gives (e.g. with a Rect for the bounding box, not a list)."""
+    if not hasattr(anim, 'ToDict'):
+        anim = prt_file.AnimationTable([anim])[0]
+    return anim.ToDict()
+
+def WriteAnimationMetadata(base_path, animations, num_optional_entries, fmt):
+    """Writes the animations (an iterable of animation views or dicts, e.g. a prt_file.AnimationTable or PRTFile.IterAnimations()) and
+    num_optional_entries in the given format.
+
+    YAML and JSON are written as the animations come in.  The binary format stores whole columns, so animations that aren't already in a
+    prt_file.AnimationTable are collected into one first.
+    """
+    storage = _Storage(base_path)
+    filename = MetadataName('animations', fmt)
+    if fmt == 'yaml':
+        with storage.Open(filename, 'w') as f:
+            # Dumping one batch of entries at a time produces the same text as dumping the whole mapping at once, since the (int) keys are
+            # written in order either way.
+            for batch in _Batches(enumerate(animations), YAML_BATCH_SIZE):
+                f.write(yaml.dump(dict((i, _AnimationDict(anim)) for i, anim in batch), Dumper=yaml.CDumper))
+            # since we don't know where to put this at the moment...
+            f.write(yaml.dump({'num_optional_entries': num_optional_entries}, Dumper=yaml.CDumper))
+    elif fmt == 'json':
+        with storage.Open(filename, 'w') as f:
+            f.write('{"num_optional_entries": %d, "animations": [' % num_optional_entries)
+            for i, anim in enumerate(animations):
+                f.write(',\n' if i else '\n')
+                json.dump(_AnimationDict(anim), f)
+            f.write('\n]}\n')
+    elif fmt == 'binary':
+        if not isinstance(animations, prt_file.AnimationTable):
+            animations = prt_file.AnimationTable(animations)
+        with storage.Open(filename, 'wb') as f:
+            f.write(BINARY_HEADER.pack(BINARY_SIGNATURE, BINARY_VERSION))
+            f.write(prt_file.UINT32.pack(num_optional_entries))
+            animations.Serialize(f)
+    else:
+        raise ValueError('invalid format')
+
+def _Batches(iterable, size):
+    """Yields lists of up to size consecutive items of iterable."""
+    it = iter(iterable)
+    while True:
+        batch = list(itertools.islice(it, size))
+        if not batch:
+            return
+        yield batch
+
+class _NotStreamable(Exception):
+    """The metadata file is valid, but not laid out in a way that AnimationMetadataReader can read piecemeal."""
+    pass
+
+def _YAMLEntries(f):
+    """Yields the text of batches of top-level entries of the block-style YAML mapping in open file f.  An entry starts at a line that begins
+    with anything but whitespace, a comment or an (indentless) sequence item."""
+    entry_count = 0
+    lines = []
+    for line in f:
+        if line.startswith('---') or line.startswith('...'):
+            if entry_count or lines:
+                # more than one document
+                raise _NotStreamable()
+            continue
+        if line[:1] not in ' \t\r\n#-':
+            if line[:1] in '{[?&*!|>"\'%':
+                # flow style, complex keys, anchors and aliases etc.
+                raise _NotStreamable()
+            if entry_count == YAML_BATCH_SIZE:
+                yield ''.join(lines)
+                entry_count = 0
+                lines = []
+            entry_count = entry_count + 1
+        lines.append(line)
+    if lines:
+        yield ''.join(lines)
+
+class AnimationMetadataReader(object):
+    """Reads the animation metadata written by WriteAnimationMetadata one animation at a time.
+
+    Iterating over the reader yields the animations in ID order (dicts for YAML and JSON, views for the binary format).  num_optional_entries is
+    set once they have all been read, or straight away if it can be found without parsing them (it is at the start of JSON files and at the end
+    of YAML files written by WriteAnimationMetadata).  YAML files are parsed a batch of entries at a time, which needs the top-level entries to be in ID order,
+    as written by the extractor; otherwise iterating raises MetadataLoadError (ReadAnimationMetadata falls back to parsing the whole file then).
+    """
+    def __init__(self, base_path, fmt):
+        if fmt not in METADATA_FORMATS:
+            raise ValueError('invalid format')
+        self._storage = _Storage(base_path)
+        self._fmt = fmt
+        self._filename = MetadataName('animations', fmt)
+        self.num_optional_entries = None
+        if fmt == 'yaml':
+            with self._storage.Open(self._filename) as f:
+                f.seek(0, os.SEEK_END)
+                f.seek(max(0, f.tell() - YAML_TAIL_SIZE))
+                match = YAML_NUM_OPTIONAL_ENTRIES.search(f.read())
+            if match:
+                self.num_optional_entries = int(match.group(1))
+        elif fmt == 'json':
+            with self._storage.Open(self._filename) as f:
+                match = JSON_STREAM_HEADER.match(f.readline().rstrip('\r\n'))
+            if match:
+                self.num_optional_entries = int(match.group(1))
+
+    def __iter__(self):
+        try:
+            for anim in getattr(self, '_Iter' + self._fmt.capitalize())():
+                yield anim
+        except _NotStreamable:
+            raise MetadataLoadError('%s: entries are not in a form that can be read one at a time' % self._filename)
+        if self.num_optional_entries is None:
+            raise MetadataLoadError('%s: num_optional_entries is missing' % self._filename)
+
+    def _IterYaml(self):
+        expected = 0
+        with self._storage.Open(self._filename) as f:
+            for text in _YAMLEntries(f):
+                try:
+                    batch = yaml.load(text, Loader=yaml.CLoader)
+                except yaml.YAMLError:
+                    # e.g. an alias of an anchor in another batch; the whole file may still be fine
+                    raise _NotStreamable()
+                if not isinstance(batch, dict):
+                    raise _NotStreamable()
+                if 'num_optional_entries' in batch:
+                    self.num_optional_entries = batch.pop('num_optional_entries')
+                for k in sorted(batch):
+                    if not isinstance(k, (int, long)) or k < expected:
+                        raise _NotStreamable()
+                    expected = k + 1
+                    yield batch[k]
+
+    def _IterJson(self):
+        with self._storage.Open(self._filename) as f:
+            match = JSON_STREAM_HEADER.match(f.readline().rstrip('\r\n'))
+            if match is None:
+                f.seek(0)
+                metadata = json.load(f)
+                self.num_optional_entries = metadata['num_optional_entries']
+                for anim in metadata['animations']:
+                    yield anim
+                return
+            for line in f:
+                line = line.rstrip(',\r\n')
+                if line == ']}':
+                    self.num_optional_entries = int(match.group(1))
+                    return
+                yield json.loads(line)
+        raise MetadataLoadError('%s: truncated file' % self._filename)
+
+    def _IterBinary(self):
+        self.num_optional_entries, animations = _ReadBinaryAnimations(self._storage.Read(self._filename), self._filename)
+        for anim in animations:
+            yield anim
+
+def _ReadBinaryAnimations(data, filename):
+    offset = _ReadBinaryHeader(data, filename)
+    if len(data) < offset + prt_file.UINT32.size:
+        raise MetadataLoadError('%s: file too short' % filename)
+    num_optional_entries, = prt_file.UINT32.unpack_from(data, offset)
+    try:
+        animations, end = prt_file.AnimationTable.Deserialize(data, offset + prt_file.UINT32.size)
+    except ValueError as e:
+        raise MetadataLoadError('%s: %s' % (filename, e))
+    if end != len(data):
+        raise MetadataLoadError('%s: unexpected data after the animation table' % filename)
+    return num_optional_entries, animations
+
+def ReadAnimationMetadata(base_path, fmt):
+    """Reads the animation metadata written by WriteAnimationMetadata.  Returns (num_optional_entries, prt_file.AnimationTable)."""
+    filename = MetadataName('animations', fmt)
+    storage = _Storage(base_path)
+    if fmt == 'binary':
+        return _ReadBinaryAnimations(storage.Read(filename), filename)
+    reader = AnimationMetadataReader(storage, fmt)
+    try:
+        animations = prt_file.AnimationTable(reader)
+        return reader.num_optional_entries, animations
+    except MetadataLoadError:
+        if fmt != 'yaml':
+            raise
+    # not laid out as the extractor writes it: parse it all at once
+    metadata = yaml.load(str(storage.Read(filename)), Loader=yaml.CLoader)
+    num_optional_entries = metadata['num_optional_entries']
+    del metadata['num_optional_entries']
+    return num_optional_entries, prt_file.AnimationTable(metadata[k] for k in sorted(metadata.iterkeys()))
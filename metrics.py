@@ -0,0 +1,141 @@
+"""Per-phase timing and resource metrics for the command line tools.
+
+A MetricsRecorder is handed to PRTFile (see PRTFile.metrics) and used by the programs themselves to time their phases.  Each phase records wall
+and CPU time, how many bytes and records it processed and the peak RSS of the process when it finished.  One phase can also be run under
+cProfile.  Phases may be nested (the PRTFile phases run inside the programs' load and write phases); every phase is reported on its own.
+"""
+
+import contextlib
+import cProfile
+import json
+import os
+import sys
+import timeit
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows; peak RSS is simply not reported there
+    resource = None
+
+METRICS_VERSION = 1
+
+def PeakRSS():
+    """Returns the peak resident set size of the process in bytes, or None if it can't be determined."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on OS X, kilobytes everywhere else
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def _CPUTime():
+    t = os.times()
+    return t[0] + t[1]
+
+class Phase(object):
+    """The measurements of one phase.  Code running in the phase fills in bytes and records."""
+    def __init__(self, name):
+        self.name = name
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.bytes = 0
+        self.records = 0
+        self.peak_rss = None
+
+    def ToDict(self):
+        d = {
+            'name': self.name,
+            'wall_seconds': self.wall_seconds,
+            'cpu_seconds': self.cpu_seconds,
+            'bytes': self.bytes,
+            'records': self.records,
+            'peak_rss_bytes': self.peak_rss,
+        }
+        if self.wall_seconds > 0:
+            d['bytes_per_second'] = self.bytes / self.wall_seconds
+            d['records_per_second'] = self.records / self.wall_seconds
+        return d
+
+class MetricsRecorder(object):
+    """Records phases in the order they start.  If profile_phase is set, the phase of that name is run under cProfile, and its stats are written to
+    profile_output (see pstats)."""
+    def __init__(self, program, profile_phase=None, profile_output=None):
+        self.program = program
+        self.phases = []
+        self._profile_phase = profile_phase
+        self._profile_output = profile_output or '%s.prof' % profile_phase
+        self._start = timeit.default_timer()
+        self._start_cpu = _CPUTime()
+
+    @contextlib.contextmanager
+    def Phase(self, name):
+        """Context manager timing the phase name.  Yields the Phase, so the code in it can fill in bytes and records."""
+        phase = Phase(name)
+        self.phases.append(phase)
+        profiler = None
+        if name == self._profile_phase:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        start = timeit.default_timer()
+        start_cpu = _CPUTime()
+        try:
+            yield phase
+        finally:
+            phase.wall_seconds = timeit.default_timer() - start
+            phase.cpu_seconds = _CPUTime() - start_cpu
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(self._profile_output)
+            phase.peak_rss = PeakRSS()
+
+    def ToDict(self):
+        return {
+            'version': METRICS_VERSION,
+            'program': self.program,
+            'wall_seconds': timeit.default_timer() - self._start,
+            'cpu_seconds': _CPUTime() - self._start_cpu,
+            'peak_rss_bytes': PeakRSS(),
+            'phases': [phase.ToDict() for phase in self.phases],
+        }
+
+    def WriteJSON(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.ToDict(), f, indent=2, sort_keys=True)
+
+    def PrintSummary(self, f=sys.stdout):
+        """Prints a table of the phases."""
+        f.write('%-28s %9s %9s %12s %9s %11s\n' % ('phase', 'wall (s)', 'cpu (s)', 'bytes', 'records', 'peak RSS'))
+        for phase in self.phases:
+            rss = '%.1f MiB' % (phase.peak_rss / 1048576.0) if phase.peak_rss is not None else '-'
+            f.write('%-28s %9.3f %9.3f %12d %9d %11s\n' % (phase.name, phase.wall_seconds, phase.cpu_seconds, phase.bytes, phase.records, rss))
+        total = self.ToDict()
+        f.write('%-28s %9.3f %9.3f\n' % ('total', total['wall_seconds'], total['cpu_seconds']))
+
+class NullRecorder(object):
+    """Stands in for a MetricsRecorder when nothing is being recorded."""
+    @contextlib.contextmanager
+    def Phase(self, name):
+        yield Phase(name)
+
+def AddArguments(parser):
+    """Adds the --profile, --metrics_json and --cprofile options to an argparse parser."""
+    parser.add_argument('--profile', action='store_true', default=False, help='Prints the time, data processed and memory use of each phase.')
+    parser.add_argument('--metrics_json', help='Writes the metrics of each phase to this file as JSON.')
+    parser.add_argument('--cprofile', metavar='PHASE', help='Runs the named phase (see --profile for the names) under cProfile.  Only the main '
+        'thread is profiled, not the --jobs worker threads.')
+    parser.add_argument('--cprofile_output', help='File to write the --cprofile stats to (default <PHASE>.prof).  Read it with the pstats module.')
+
+def FromArguments(args, program):
+    """Returns a MetricsRecorder if any of the AddArguments options were given, otherwise a NullRecorder."""
+    if args.profile or args.metrics_json or args.cprofile:
+        return MetricsRecorder(program, profile_phase=args.cprofile, profile_output=args.cprofile_output)
+    return NullRecorder()
+
+def Report(recorder, args):
+    """Prints and/or writes the recorded metrics, as requested by the AddArguments options."""
+    if isinstance(recorder, NullRecorder):
+        return
+    if args.profile:
+        recorder.PrintSummary()
+    if args.metrics_json:
+        recorder.WriteJSON(args.metrics_json)
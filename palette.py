@@ -25,102 +25,206 @@ PAL_FORMATS = {
 class PaletteLoadError(Exception):
     pass
 
+def SwapRedBlue(data):
+    """Returns a copy of a 4-byte-per-entry color table with the first and third channels swapped."""
+    swapped = bytearray(data)
+    swapped[0::4] = data[2::4]
+    swapped[2::4] = data[0::4]
+    return swapped
+
+class _ColorList(collections.MutableSequence):
+    """The colors of a Palette as a list of Color tuples, read from and written straight through to the palette's data."""
+    def __init__(self, pal):
+        self._palette = pal
+
+    def _Index(self, i):
+        n = len(self)
+        if i < 0:
+            i = i + n
+        if i < 0 or i >= n:
+            raise IndexError('color index out of range')
+        return i
+
+    def __len__(self):
+        return len(self._palette.data) // 4
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in xrange(*i.indices(len(self)))]
+        i = self._Index(i) * 4
+        return Color(*self._palette.data[i:i + 4])
+
+    def __setitem__(self, i, value):
+        if isinstance(i, slice):
+            colors = list(self)
+            colors[i] = value
+            self._palette.colors = colors
+            return
+        i = self._Index(i) * 4
+        self._palette.data[i:i + 4] = bytearray((value.r, value.g, value.b, value.flags))
+
+    def __delitem__(self, i):
+        colors = list(self)
+        del colors[i]
+        self._palette.colors = colors
+
+    def insert(self, i, value):
+        i = max(0, min(len(self), i + len(self) if i < 0 else i)) * 4
+        self._palette.data[i:i] = bytearray((value.r, value.g, value.b, value.flags))
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(list(self))
+
 class Palette(object):
+    """A color table.
+
+    The colors are stored as one contiguous bytearray of (r, g, b, flags) entries (see data), which is what all of the file I/O works on.  Palettes
+    are shared by many bitmaps and read from several threads at once, so reading never changes that representation: colors is a list-like view
+    of the data, and changes made through it (e.g. pal.colors[i] = c or pal.colors.append(c)) go straight into the data.
+    """
     def __init__(self):
-        self.colors = []
+        self._data = bytearray()
+
+    @property
+    def data(self):
+        """The color table as a bytearray of (r, g, b, flags) entries."""
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = bytearray(value)
+
+    @property
+    def colors(self):
+        """The color table as a list of Color tuples, writing through to data.  Use list(pal.colors) for a copy."""
+        return _ColorList(self)
+
+    @colors.setter
+    def colors(self, value):
+        colors = list(value)
+        data = bytearray(len(colors) * 4)
+        data[0::4] = bytearray(c.r for c in colors)
+        data[1::4] = bytearray(c.g for c in colors)
+        data[2::4] = bytearray(c.b for c in colors)
+        data[3::4] = bytearray(c.flags for c in colors)
+        self._data = data
+
+    def NumColors(self):
+        return len(self._data) // 4
+
+    def Key(self):
+        """Returns a hashable key that is equal for palettes with identical color tables."""
+        return str(self.data)
 
     def ReadColorTable(self, f, num_colors=256, reverse=False, file_format=PAL):
-        """Reads the color table from open file f."""
-        for i in xrange(num_colors):
-            if file_format == PAL:
-                rgba = PAL_ENTRY.unpack(f.read(4))
-                if reverse:
-                    self.colors.append(Color(r=rgba[2], g=rgba[1], b=rgba[0], flags=rgba[3]))
-                else:
-                    self.colors.append(Color(r=rgba[0], g=rgba[1], b=rgba[2], flags=rgba[3]))
-            elif file_format == ACT:
-                rgb = struct.unpack('<3B', f.read(3))
-                if reverse:
-                    self.colors.append(Color(r=rgb[2], g=rgb[1], b=rgb[0], flags=0))
-                else:
-                    self.colors.append(Color(r=rgb[0], g=rgb[1], b=rgb[2], flags=0))
-            elif file_format == TEXT:
+        """Reads the color table from open file f, appending it to the palette."""
+        if file_format == PAL:
+            data = f.read(num_colors * 4)
+            if len(data) != num_colors * 4:
+                raise PaletteLoadError('ran out of color data')
+            self.data.extend(SwapRedBlue(data) if reverse else data)
+        elif file_format == ACT:
+            rgb = f.read(num_colors * 3)
+            if len(rgb) != num_colors * 3:
+                raise PaletteLoadError('ran out of color data')
+            # flags are left as 0
+            data = bytearray(num_colors * 4)
+            data[0::4] = rgb[2::3] if reverse else rgb[0::3]
+            data[1::4] = rgb[1::3]
+            data[2::4] = rgb[0::3] if reverse else rgb[2::3]
+            self.data.extend(data)
+        elif file_format == TEXT:
+            data = bytearray(num_colors * 4)
+            for i in xrange(num_colors):
                 rgb = f.readline().split(None, 3)
-                self.colors.append(Color(r=int(rgb[0]), g=int(rgb[1]), b=int(rgb[2]), flags=0))
-            else:
-                raise ValueError('invalid format')
+                data[i * 4:i * 4 + 3] = bytearray((int(rgb[0]), int(rgb[1]), int(rgb[2])))
+            self.data.extend(data)
+        else:
+            raise ValueError('invalid format')
 
-    def WriteColorTable(self, f, reverse=False, file_format=PAL):
-        """Writes the color table to open file f."""
+    def WriteColorTable(self, f, reverse=False, file_format=PAL, num_colors=None):
+        """Writes the color table (only its first num_colors entries, if given) to open file f."""
+        data = self.data if num_colors is None else self.data[:num_colors * 4]
         # Color data (windows LOGPALETTE format)
-        for color in self.colors:
-            if file_format == PAL:
-                if reverse:
-                    packed_color = PAL_ENTRY.pack(color.b, color.g, color.r, color.flags)
-                else:
-                    packed_color = PAL_ENTRY.pack(color.r, color.g, color.b, color.flags)
-                f.write(packed_color)
-            elif file_format == ACT:
-                if reverse:
-                    f.write(struct.pack('<3B', color.b, color.g, color.r))
-                else:
-                    f.write(struct.pack('<3B', color.r, color.g, color.b))
-            elif file_format == TEXT:
+        if file_format == PAL:
+            f.write(SwapRedBlue(data) if reverse else data)
+        elif file_format == ACT:
+            rgb = bytearray(len(data) // 4 * 3)
+            rgb[0::3] = data[2::4] if reverse else data[0::4]
+            rgb[1::3] = data[1::4]
+            rgb[2::3] = data[0::4] if reverse else data[2::4]
+            f.write(rgb)
+        elif file_format == TEXT:
+            for color in self.colors[:num_colors]:
                 f.write('%d %d %d\n' % (color.r, color.g, color.b))
-            else:
-                raise ValueError('invalid format')
+        else:
+            raise ValueError('invalid format')
 
     def LoadPAL(self, filename, file_format=TEXT):
         """Loads a palette from filename."""
         with open(filename, 'rb') as f:
-            if file_format == PAL:
-                riff_tag, riff_size = RIFF_HEADER.unpack(f.read(8))
-                if riff_tag != 'RIFF':
-                    raise PaletteLoadError('Palette file is not a RIFF file')
-                if riff_size != 16:
-                    raise PaletteLoadError('Invalid RIFF section size')
-                pal_tag, pal_size, pal_ver, pal_colors = PAL_HEADER.unpack(f.read(16))
-                if pal_tag != 'PAL data':
-                    raise PaletteLoadError('PAL data section is missing')
-                if pal_ver != 0x0300:
-                    raise PaletteLoadError('Expected version 0x0300, got %x' % pal_ver)
-                if pal_size != pal_colors * 4 + 4:
-                    raise PaletteLoadError('Invalid palette size (%d, expected %d)' % (pal_size, pal_colors * 4 + 4))
-                self.ReadColorTable(f, num_colors=pal_colors, reverse=True)
-            elif file_format == TEXT:
-                sig = f.readline().strip()
-                if sig != 'JASC-PAL':
-                    raise PaletteLoadError('Palette file is not a text palette')
-                ver = f.readline().strip()
-                if ver != '0100':
-                    raise PaletteLoadError('Wrong version')
-                num_colors = int(f.readline().strip())
-                self.ReadColorTable(f, num_colors=num_colors, file_format=TEXT)
-            elif file_format == ACT:
-                # No header, just read raw RGB data
-                self.ReadColorTable(f, num_colors=256, reverse=True, file_format=ACT)
-            else:
-                raise ValueError('invalid format')
+            self.LoadPALFromOpenFile(f, file_format=file_format)
+
+    def LoadPALFromOpenFile(self, f, file_format=TEXT):
+        """Loads a palette from an open file handle."""
+        if file_format == PAL:
+            riff_tag, riff_size = RIFF_HEADER.unpack(f.read(8))
+            if riff_tag != 'RIFF':
+                raise PaletteLoadError('Palette file is not a RIFF file')
+            if riff_size != 16:
+                raise PaletteLoadError('Invalid RIFF section size')
+            pal_tag, pal_size, pal_ver, pal_colors = PAL_HEADER.unpack(f.read(16))
+            if pal_tag != 'PAL data':
+                raise PaletteLoadError('PAL data section is missing')
+            if pal_ver != 0x0300:
+                raise PaletteLoadError('Expected version 0x0300, got %x' % pal_ver)
+            if pal_size != pal_colors * 4 + 4:
+                raise PaletteLoadError('Invalid palette size (%d, expected %d)' % (pal_size, pal_colors * 4 + 4))
+            self.ReadColorTable(f, num_colors=pal_colors, reverse=True)
+        elif file_format == TEXT:
+            sig = f.readline().strip()
+            if sig != 'JASC-PAL':
+                raise PaletteLoadError('Palette file is not a text palette')
+            ver = f.readline().strip()
+            if ver != '0100':
+                raise PaletteLoadError('Wrong version')
+            num_colors = int(f.readline().strip())
+            self.ReadColorTable(f, num_colors=num_colors, file_format=TEXT)
+        elif file_format == ACT:
+            # No header, just read raw RGB data
+            self.ReadColorTable(f, num_colors=256, reverse=True, file_format=ACT)
+        else:
+            raise ValueError('invalid format')
 
     def WritePAL(self, filename, file_format=TEXT):
         """Writes the palette to filename."""
         with open(filename, 'wb') as f:
-            if file_format == PAL:
-                # RIFF format: fourcc ("RIFF"), length
-                # PAL chunk format: fourcc ("PAL "), "data", length, version (0x0300), num colors
-                data_header = PAL_HEADER.pack('PAL data', len(self.colors) * 4 + 4, 0x0300, len(self.colors))
-                riff_header = RIFF_HEADER.pack('RIFF', len(data_header))
-                f.write(riff_header)
-                f.write(data_header)
-                self.WriteColorTable(f, reverse=True)
-            elif file_format == TEXT:
-                f.write('JASC-PAL\n')
-                f.write('0100\n')
-                f.write('%d\n' % len(self.colors))
-                self.WriteColorTable(f, file_format=TEXT)
-            elif file_format == ACT:
-                if len(self.colors) != 256:
-                    raise ValueError('Photoshop ACT format supports only 256 colors')
-                self.WriteColorTable(f, reverse=True, file_format=ACT)
-            else:
-                raise ValueError('invalid format')
+            self.WritePALToOpenFile(f, file_format=file_format)
+
+    def WritePALToOpenFile(self, f, file_format=TEXT):
+        """Writes the palette to an open file handle."""
+        if file_format == PAL:
+            # RIFF format: fourcc ("RIFF"), length
+            # PAL chunk format: fourcc ("PAL "), "data", length, version (0x0300), num colors
+            data_header = PAL_HEADER.pack('PAL data', self.NumColors() * 4 + 4, 0x0300, self.NumColors())
+            riff_header = RIFF_HEADER.pack('RIFF', len(data_header))
+            f.write(riff_header)
+            f.write(data_header)
+            self.WriteColorTable(f, reverse=True)
+        elif file_format == TEXT:
+            f.write('JASC-PAL\n')
+            f.write('0100\n')
+            f.write('%d\n' % self.NumColors())
+            self.WriteColorTable(f, file_format=TEXT)
+        elif file_format == ACT:
+            if self.NumColors() != 256:
+                raise ValueError('Photoshop ACT format supports only 256 colors')
+            self.WriteColorTable(f, reverse=True, file_format=ACT)
+        else:
+            raise ValueError('invalid format')
@@ -0,0 +1,69 @@
+"""Palette interning: collapses duplicate bitmap palettes into shared PRT palette entries."""
+
+import palette
+
+class _MergedPalette(object):
+    """A palette shared by several bitmaps, tracking which entries those bitmaps actually use."""
+    def __init__(self, pal):
+        self.palette = pal
+        self.fixed = {}
+
+    def Accepts(self, colors, used):
+        fixed = self.fixed
+        for i in used:
+            c = fixed.get(i)
+            if c is not None and c != colors[i]:
+                return False
+        return True
+
+    def Add(self, colors, used):
+        for i in used:
+            self.fixed[i] = colors[i]
+
+    def Build(self):
+        pal = palette.Palette()
+        colors = list(self.palette.colors)
+        for i, c in self.fixed.iteritems():
+            colors[i] = c
+        pal.colors = colors
+        return pal
+
+def InternPalettes(bitmaps, merge_unused=False):
+    """Gives every group of bitmaps with identical palettes one shared palette, rewriting each bitmap's palette and palette_id.
+
+    With merge_unused, palettes are also merged when they only differ in entries that the bitmaps sharing them never use.  Returns the list of unique
+    palettes, to be stored in the PRT.
+    """
+    # Exact duplicates first: these are cheap to find and usually account for nearly all of the palettes
+    unique = {}
+    groups = []
+    for bmp in bitmaps:
+        key = bmp.palette.Key()
+        group = unique.get(key)
+        if group is None:
+            group = unique[key] = len(groups)
+            groups.append((bmp.palette, []))
+        groups[group][1].append(bmp)
+    if merge_unused:
+        merged = []
+        assignment = []
+        for pal, members in groups:
+            used = frozenset().union(*[bmp.UsedColors() for bmp in members])
+            colors = list(pal.colors)
+            for j, m in enumerate(merged):
+                if m.Accepts(colors, used):
+                    break
+            else:
+                j = len(merged)
+                merged.append(_MergedPalette(pal))
+            merged[j].Add(colors, used)
+            assignment.append(j)
+        palettes = [m.Build() for m in merged]
+    else:
+        assignment = range(len(groups))
+        palettes = [pal for pal, members in groups]
+    for (pal, members), j in zip(groups, assignment):
+        for bmp in members:
+            bmp.palette = palettes[j]
+            bmp.palette_id = j
+    return palettes
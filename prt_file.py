@@ -1,238 +1,1290 @@
 """Objects and reading/writing routines for PRT files."""
 
+import array
+import cStringIO
 import collections
+import hashlib
+import itertools
+import mmap
+import operator
+import os
 import struct
+import sys
+import threading
 
 import bitmap
+import metrics
 import palette
 
 Rect = collections.namedtuple('Rect', ['left', 'top', 'right', 'bottom'])
 Point = collections.namedtuple('Point', ['x', 'y'])
 
+# PRT record layouts
+SECTION_HEADER = struct.Struct('<4s I')
+UINT32 = struct.Struct('<I')
+PALETTE_DATA = struct.Struct('<1024s')
+BITMAP_RECORD = struct.Struct('<IIIIhh')
+ANIMATION_RECORD = struct.Struct('<IIIIIIIII')
+FRAME_HEADER = struct.Struct('<BB')
+FRAME_OPTIONAL = struct.Struct('<2B')
+SUBFRAME_RECORD = struct.Struct('<hBBhh')
+APPENDIX_RECORD = struct.Struct('<4I')
+# PPAL section header, head section and data section header that precede each palette's color data
+PALETTE_SECTIONS = struct.Struct('<4s I 4s I I 4s I')
+# snapshot (see Load): signature, version, layout hash, num_optional_entries, bmp data offset, number of palettes and bitmaps
+SNAPSHOT_HEADER = struct.Struct('<4s I 20s I I I I')
+SNAPSHOT_SIGNATURE = 'PRTS'
+# Bump whenever the snapshot layout changes (changes to the animation table columns are picked up by the layout hash)
+SNAPSHOT_VERSION = 1
+
+_run_structs = {}
+
+def _RunStruct(record, count):
+    """Returns a (cached) Struct that decodes count consecutive records of the given record Struct in one call."""
+    key = (record.format, count)
+    s = _run_structs.get(key)
+    if s is None:
+        s = _run_structs[key] = struct.Struct('<' + record.format.lstrip('<') * count)
+    return s
+
 class PRTLoadError(Exception):
     pass
 
+class PRTWriteError(Exception):
+    pass
+
+class _BatchWriter(object):
+    """Collects small packed records and writes them to an open file in large chunks."""
+    def __init__(self, f, chunk_size=1 << 20):
+        self._f = f
+        self._chunk_size = chunk_size
+        self._buf = bytearray()
+        self.bytes_written = 0
+
+    def Write(self, data):
+        self._buf += data
+        self.bytes_written += len(data)
+        if len(self._buf) >= self._chunk_size:
+            self.Flush()
+
+    def Pack(self, s, *values):
+        self.Write(s.pack(*values))
+
+    def Flush(self):
+        if self._buf:
+            self._f.write(self._buf)
+            self._buf = bytearray()
+
+NO_OPTIONAL = -1  # stored in the optional frame columns in place of None
+
+def _ColumnProperty(column):
+    """Property for a view that reads/writes element _row of the named table column."""
+    def fget(self):
+        # int() since 'I' arrays hand back longs, which would leak into the YAML metadata
+        return int(getattr(self._table, column)[self._row])
+    def fset(self, value):
+        getattr(self._table, column)[self._row] = value
+    return property(fget, fset)
+
+def _OptionalColumnProperty(column):
+    """Like _ColumnProperty, but maps None to/from NO_OPTIONAL."""
+    def fget(self):
+        value = getattr(self._table, column)[self._row]
+        return None if value == NO_OPTIONAL else int(value)
+    def fset(self, value):
+        getattr(self._table, column)[self._row] = NO_OPTIONAL if value is None else int(value)
+    return property(fget, fset)
+
+class _RowView(object):
+    """Base class for views onto one row of an AnimationTable.  Fields can be accessed as attributes or as dict items."""
+    __slots__ = ('_table', '_row')
+    _KEYS = ()
+
+    def __init__(self, table, row):
+        self._table = table
+        self._row = row
+
+    def __getitem__(self, key):
+        if key not in self._KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self._KEYS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self._KEYS
+
+    def keys(self):
+        return list(self._KEYS)
+
+    def get(self, key, default=None):
+        return self[key] if key in self._KEYS else default
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.ToDict())
+
+class _ListView(object):
+    """Read-only sequence of row views over rows [start, start + count) of a table."""
+    __slots__ = ('_table', '_start', '_count', '_view')
+
+    def __init__(self, table, start, count, view):
+        self._table = table
+        self._start = start
+        self._count = count
+        self._view = view
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i = i + self._count
+        if i < 0 or i >= self._count:
+            raise IndexError('index out of range')
+        return self._view(self._table, self._start + i)
+
+    def __iter__(self):
+        view = self._view
+        for row in xrange(self._start, self._start + self._count):
+            yield view(self._table, row)
+
+class SubframeView(_RowView):
+    __slots__ = ()
+    _KEYS = ('bitmap_id', 'unknown', 'subframe_id', 'offset')
+    bitmap_id = _ColumnProperty('subframe_bitmap_id')
+    unknown = _ColumnProperty('subframe_unknown')
+    subframe_id = _ColumnProperty('subframe_id')
+
+    @property
+    def offset(self):
+        return Point(x=self._table.subframe_x[self._row], y=self._table.subframe_y[self._row])
+
+    @offset.setter
+    def offset(self, value):
+        self._table.subframe_x[self._row], self._table.subframe_y[self._row] = value
+
+    def ToDict(self):
+        return {
+            'bitmap_id': self.bitmap_id,
+            'unknown': self.unknown,
+            'subframe_id': self.subframe_id,
+            'offset': self.offset,
+        }
+
+class FrameView(_RowView):
+    __slots__ = ()
+    _KEYS = ('subframes', 'unknown', 'optional1', 'optional2', 'optional3', 'optional4')
+    unknown = _ColumnProperty('frame_unknown')
+    optional1 = _OptionalColumnProperty('frame_optional1')
+    optional2 = _OptionalColumnProperty('frame_optional2')
+    optional3 = _OptionalColumnProperty('frame_optional3')
+    optional4 = _OptionalColumnProperty('frame_optional4')
+
+    @property
+    def subframes(self):
+        t = self._table
+        return _ListView(t, t.frame_subframe_start[self._row], t.frame_subframe_count[self._row], SubframeView)
+
+    def ToDict(self):
+        return {
+            'subframes': [sf.ToDict() for sf in self.subframes],
+            'unknown': self.unknown,
+            'optional1': self.optional1,
+            'optional2': self.optional2,
+            'optional3': self.optional3,
+            'optional4': self.optional4
+        }
+
+class AnimationView(_RowView):
+    __slots__ = ()
+    _KEYS = ('unknown1', 'bounding_box', 'offset', 'unknown2', 'frames', 'unknown3', 'appendix')
+    unknown1 = _ColumnProperty('anim_unknown1')
+    unknown2 = _ColumnProperty('anim_unknown2')
+    unknown3 = _ColumnProperty('anim_unknown3')
+
+    @property
+    def bounding_box(self):
+        t = self._table
+        r = self._row
+        return Rect(left=int(t.anim_left[r]), top=int(t.anim_top[r]), right=int(t.anim_right[r]), bottom=int(t.anim_bottom[r]))
+
+    @bounding_box.setter
+    def bounding_box(self, value):
+        t = self._table
+        r = self._row
+        t.anim_left[r], t.anim_top[r], t.anim_right[r], t.anim_bottom[r] = value
+
+    @property
+    def offset(self):
+        return Point(x=int(self._table.anim_x[self._row]), y=int(self._table.anim_y[self._row]))
+
+    @offset.setter
+    def offset(self, value):
+        self._table.anim_x[self._row], self._table.anim_y[self._row] = value
+
+    @property
+    def frames(self):
+        t = self._table
+        return _ListView(t, t.anim_frame_start[self._row], t.anim_frame_count[self._row], FrameView)
+
+    @property
+    def appendix(self):
+        """The appendix rows as a tuple of 4-tuples.  They can only be changed by assigning new rows (see AnimationTable.SetAppendix)."""
+        t = self._table
+        start = t.anim_appendix_start[self._row] * 4
+        return tuple(tuple(map(int, t.appendix[i:i + 4])) for i in xrange(start, start + t.anim_appendix_count[self._row] * 4, 4))
+
+    @appendix.setter
+    def appendix(self, rows):
+        self._table.SetAppendix(self._row, rows)
+
+    def ToDict(self):
+        return {
+            'unknown1': self.unknown1,
+            'bounding_box': self.bounding_box,
+            'offset': self.offset,
+            'unknown2': self.unknown2,
+            'frames': [frame.ToDict() for frame in self.frames],
+            'unknown3': self.unknown3,
+            'appendix': map(list, self.appendix)
+        }
+
+class AnimationTable(object):
+    """Columnar storage for the PRT animation table.
+
+    Animations, frames, subframes and appendix rows are each stored as parallel typed arrays, linked by start/count columns (appendix rows are stored
+    flattened, 4 values per row).  Indexing the table returns an AnimationView, so anim.frames[i].subframes[j].bitmap_id (or the equivalent dict-style
+    anim['frames'][i]['subframes'][j]['bitmap_id']) works as it did when animations were plain dicts.
+    """
+    ANIMATION_COLUMNS = [('anim_unknown1', 'I'), ('anim_left', 'I'), ('anim_top', 'I'), ('anim_right', 'I'), ('anim_bottom', 'I'), ('anim_x', 'I'),
+            ('anim_y', 'I'), ('anim_unknown2', 'I'), ('anim_unknown3', 'I'), ('anim_frame_start', 'I'), ('anim_frame_count', 'I'),
+            ('anim_appendix_start', 'I'), ('anim_appendix_count', 'I')]
+    FRAME_COLUMNS = [('frame_anim', 'I'), ('frame_subframe_start', 'I'), ('frame_subframe_count', 'I'), ('frame_unknown', 'B'), ('frame_optional1', 'h'),
+            ('frame_optional2', 'h'), ('frame_optional3', 'h'), ('frame_optional4', 'h')]
+    SUBFRAME_COLUMNS = [('subframe_frame', 'I'), ('subframe_bitmap_id', 'h'), ('subframe_unknown', 'B'), ('subframe_id', 'B'), ('subframe_x', 'h'),
+            ('subframe_y', 'h')]
+    COLUMNS = ANIMATION_COLUMNS + FRAME_COLUMNS + SUBFRAME_COLUMNS + [('appendix', 'I')]
+
+    def __init__(self, animations=()):
+        for name, typecode in self.COLUMNS:
+            setattr(self, name, array.array(typecode))
+        self.extend(animations)
+
+    def Serialize(self, f):
+        """Writes the raw columns (little-endian, each prefixed by its length) to open file f."""
+        for name, typecode in self.COLUMNS:
+            column = getattr(self, name)
+            if sys.byteorder == 'big':
+                column = array.array(typecode, column)
+                column.byteswap()
+            f.write(UINT32.pack(len(column)))
+            f.write(column.tostring())
+
+    @classmethod
+    def Deserialize(cls, data, offset=0):
+        """Reads a table written by Serialize from buffer data at offset.  Returns the table and the offset just past it."""
+        table = cls()
+        for name, typecode in cls.COLUMNS:
+            column = getattr(table, name)
+            if offset + UINT32.size > len(data):
+                raise ValueError('truncated animation table (column %s)' % name)
+            length, = UINT32.unpack_from(data, offset)
+            offset = offset + UINT32.size
+            size = length * column.itemsize
+            if offset + size > len(data):
+                raise ValueError('truncated animation table (column %s)' % name)
+            column.fromstring(buffer(data, offset, size))
+            if sys.byteorder == 'big':
+                column.byteswap()
+            offset = offset + size
+        return table, offset
+
+    def __len__(self):
+        return len(self.anim_unknown1)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i = i + len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError('animation index out of range')
+        return AnimationView(self, i)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield AnimationView(self, i)
+
+    def AddAnimation(self, unknown1, bounding_box, offset, unknown2):
+        """Appends an animation with no frames or appendix rows and returns its index."""
+        self.anim_unknown1.append(unknown1)
+        self.anim_left.append(bounding_box[0])
+        self.anim_top.append(bounding_box[1])
+        self.anim_right.append(bounding_box[2])
+        self.anim_bottom.append(bounding_box[3])
+        self.anim_x.append(offset[0])
+        self.anim_y.append(offset[1])
+        self.anim_unknown2.append(unknown2)
+        self.anim_unknown3.append(0)
+        self.anim_frame_start.append(len(self.frame_anim))
+        self.anim_frame_count.append(0)
+        self.anim_appendix_start.append(len(self.appendix) // 4)
+        self.anim_appendix_count.append(0)
+        return len(self.anim_unknown1) - 1
+
+    def AddFrame(self, anim, unknown, optional1=None, optional2=None, optional3=None, optional4=None):
+        """Appends a frame with no subframes to animation anim (which must be the last animation added) and returns its row."""
+        row = len(self.frame_anim)
+        if self.anim_frame_start[anim] + self.anim_frame_count[anim] != row:
+            raise ValueError('frames can only be added to the most recently added animation')
+        self.anim_frame_count[anim] += 1
+        self.frame_anim.append(anim)
+        self.frame_subframe_start.append(len(self.subframe_frame))
+        self.frame_subframe_count.append(0)
+        self.frame_unknown.append(unknown)
+        for column, value in ((self.frame_optional1, optional1), (self.frame_optional2, optional2), (self.frame_optional3, optional3),
+                (self.frame_optional4, optional4)):
+            column.append(NO_OPTIONAL if value is None else int(value))
+        return row
+
+    def AddSubframes(self, frame, values):
+        """Appends subframes to frame row frame (which must be the last frame added).
+
+        values is a flat sequence of (bitmap_id, unknown, subframe_id, x, y) records, as decoded from the PRT.
+        """
+        if frame != len(self.frame_anim) - 1:
+            raise ValueError('subframes can only be added to the most recently added frame')
+        count = len(values) // 5
+        self.frame_subframe_count[frame] += count
+        self.subframe_frame.extend([frame] * count)
+        self.subframe_bitmap_id.extend(values[0::5])
+        self.subframe_unknown.extend(values[1::5])
+        self.subframe_id.extend(values[2::5])
+        self.subframe_x.extend(values[3::5])
+        self.subframe_y.extend(values[4::5])
+
+    def SetAppendix(self, anim, values):
+        """Sets the appendix rows of animation anim from a flat sequence of values (4 per row) or a list of rows."""
+        flat = array.array('I')
+        for v in values:
+            if isinstance(v, (int, long)):
+                flat.append(v)
+            elif len(v) == 4:
+                flat.extend(v)
+            else:
+                raise ValueError('appendix rows must have 4 entries (got %d)' % len(v))
+        count = len(flat) // 4
+        if count <= self.anim_appendix_count[anim]:
+            # fits in place
+            start = self.anim_appendix_start[anim] * 4
+            self.appendix[start:start + len(flat)] = flat
+        else:
+            self.anim_appendix_start[anim] = len(self.appendix) // 4
+            self.appendix.extend(flat)
+        self.anim_appendix_count[anim] = count
+
+    def append(self, anim, anim_id=None):
+        """Appends an animation given in dict form (or as a view from another table).  anim_id is the animation's ID in error messages (by
+        default its index in the table).  Raises PRTWriteError if the appendix rows are malformed."""
+        i = self.AddAnimation(anim['unknown1'], anim['bounding_box'], anim['offset'], anim['unknown2'])
+        for frame in anim['frames']:
+            row = self.AddFrame(i, frame['unknown'], frame['optional1'], frame['optional2'], frame['optional3'], frame['optional4'])
+            values = []
+            for sf in frame['subframes']:
+                off = sf['offset']
+                values.extend((sf['bitmap_id'], sf['unknown'], sf['subframe_id'], off[0], off[1]))
+            self.AddSubframes(row, values)
+        self.anim_unknown3[i] = anim['unknown3']
+        try:
+            self.SetAppendix(i, anim['appendix'])
+        except ValueError as e:
+            raise PRTWriteError('animation %d: %s' % (i if anim_id is None else anim_id, e))
+
+    def extend(self, animations):
+        for anim in animations:
+            self.append(anim)
+
+    def NumFrames(self):
+        return sum(self.anim_frame_count)
+
+    def NumSubframes(self):
+        counts = self.frame_subframe_count
+        return sum(sum(counts[start:start + count]) for start, count in itertools.izip(self.anim_frame_start, self.anim_frame_count))
+
+    def LocateSubframe(self, row):
+        """Returns (animation, frame, subframe) indices for subframe row row."""
+        frame = self.subframe_frame[row]
+        anim = self.frame_anim[frame]
+        return int(anim), int(frame - self.anim_frame_start[anim]), int(row - self.frame_subframe_start[frame])
+
+    def SubframesUsingBitmap(self, bitmap_id):
+        """Returns (animation, frame, subframe) indices of every subframe that uses bitmap bitmap_id."""
+        rows = itertools.compress(itertools.count(), itertools.imap(operator.eq, self.subframe_bitmap_id, itertools.repeat(bitmap_id)))
+        return [self.LocateSubframe(row) for row in rows]
+
+def _BadFrames(anims):
+    """Returns the rows of the frames in AnimationTable anims whose subframe count or unknown byte doesn't fit in 7 bits.  The top bit of each
+    flags a pair of optional bytes in the PRT."""
+    return [row for row, (count, unknown) in enumerate(itertools.izip(anims.frame_subframe_count, anims.frame_unknown))
+            if count > 0x7F or unknown > 0x7F]
+
+def _FrameErrors(anims, row, anim_id):
+    """Returns a description of each problem with frame row row of AnimationTable anims (see _BadFrames), which belongs to animation anim_id."""
+    frame = row - anims.anim_frame_start[anims.frame_anim[row]]
+    errors = []
+    if anims.frame_subframe_count[row] > 0x7F:
+        errors.append('animation %d frame %d: too many subframes (%d, at most 127)' % (anim_id, frame, anims.frame_subframe_count[row]))
+    if anims.frame_unknown[row] > 0x7F:
+        errors.append('animation %d frame %d: unknown (%d) must be at most 127' % (anim_id, frame, anims.frame_unknown[row]))
+    return errors
+
+class ReferenceIndex(object):
+    """The reverse of the links between the records of a PRTFile: which subframes use each bitmap and which bitmaps use each palette.
+
+    Built in one pass over the subframes and bitmaps, which also collects every reference that doesn't point at anything, along with the frames
+    and appendices that can't be written (see Errors).
+    """
+    # how many problems Check lists before summing up the rest
+    MAX_ERRORS = 20
+
+    def __init__(self, prt):
+        anims = prt.animations
+        num_bitmaps = len(prt.bitmaps)
+        num_palettes = len(prt.palettes)
+        self._anims = anims
+        # subframe rows using each bitmap, and bitmap IDs using each palette
+        self.bitmap_subframes = [[] for i in xrange(num_bitmaps)]
+        self.palette_bitmaps = [[] for i in xrange(num_palettes)]
+        # references to bitmaps/palettes that don't exist: subframe rows and bitmap IDs
+        self.dangling_subframes = []
+        self.dangling_bitmaps = []
+        for row, bitmap_id in enumerate(anims.subframe_bitmap_id):
+            if 0 <= bitmap_id < num_bitmaps:
+                self.bitmap_subframes[bitmap_id].append(row)
+            else:
+                self.dangling_subframes.append(row)
+        for i, bmp in enumerate(prt.bitmaps):
+            if 0 <= bmp.palette_id < num_palettes:
+                self.palette_bitmaps[bmp.palette_id].append(i)
+            else:
+                self.dangling_bitmaps.append(i)
+        self._palette_ids = [bmp.palette_id for bmp in prt.bitmaps]
+        # the count written before the appendix rows is unknown3, so the two have to agree
+        self.bad_appendices = [i for i, (count, unknown3) in enumerate(itertools.izip(anims.anim_appendix_count, anims.anim_unknown3))
+                if count != unknown3]
+        self.bad_frames = _BadFrames(anims)
+
+    def SubframesUsingBitmap(self, bitmap_id):
+        """Returns (animation, frame, subframe) indices of every subframe that uses bitmap bitmap_id."""
+        return [self._anims.LocateSubframe(row) for row in self.bitmap_subframes[bitmap_id]]
+
+    def BitmapsUsingPalette(self, palette_id):
+        """Returns the IDs of the bitmaps using palette palette_id."""
+        return list(self.palette_bitmaps[palette_id])
+
+    def UnusedBitmaps(self):
+        """Returns the IDs of the bitmaps that no subframe uses."""
+        return [i for i, rows in enumerate(self.bitmap_subframes) if not rows]
+
+    def UnusedPalettes(self):
+        """Returns the IDs of the palettes that no bitmap uses."""
+        return [i for i, bitmaps in enumerate(self.palette_bitmaps) if not bitmaps]
+
+    def Errors(self):
+        """Returns a description of each dangling reference, and of each frame and appendix that can't be written."""
+        errors = []
+        anims = self._anims
+        for row in self.dangling_subframes:
+            errors.append('animation %d frame %d subframe %d: bitmap_id %d out of range' % (anims.LocateSubframe(row) +
+                    (anims.subframe_bitmap_id[row],)))
+        for i in self.dangling_bitmaps:
+            errors.append('bitmap %d: palette_id %d out of range' % (i, self._palette_ids[i]))
+        for row in self.bad_frames:
+            errors.extend(_FrameErrors(anims, row, anims.frame_anim[row]))
+        for i in self.bad_appendices:
+            errors.append('animation %d: unknown3 (%d) must equal the number of appendix rows (%d)' % (i, anims.anim_unknown3[i],
+                    anims.anim_appendix_count[i]))
+        return errors
+
+    def Check(self):
+        """Raises PRTWriteError listing the Errors, if there are any."""
+        errors = self.Errors()
+        if errors:
+            message = '\n'.join(errors[:self.MAX_ERRORS])
+            if len(errors) > self.MAX_ERRORS:
+                message = message + '\n(and %d more)' % (len(errors) - self.MAX_ERRORS)
+            raise PRTWriteError(message)
+
+class PRTIndex(object):
+    """Where each palette, the bitmap records and each animation start in a PRT file (see PRTFile.Open).
+
+    The index can be kept in a sidecar file next to the PRT.  It records the PRT's size and hash, and is ignored once they no longer match.
+    """
+    HEADER = struct.Struct('<4s I I 20s I I I I I I')
+    SIGNATURE = 'PRTI'
+    VERSION = 1
+
+    def __init__(self):
+        self.prt_size = 0
+        self.prt_sha1 = ''
+        self.palette_offsets = array.array('I')
+        self.bitmap_table_offset = 0
+        self.num_bitmaps = 0
+        self.animation_offsets = array.array('I')
+        self.num_optional_entries = 0
+        self.extra_data_offset = 0
+
+    def Save(self, filename):
+        """Writes the index to a sidecar file."""
+        palette_offsets = array.array('I', self.palette_offsets)
+        animation_offsets = array.array('I', self.animation_offsets)
+        if sys.byteorder == 'big':
+            palette_offsets.byteswap()
+            animation_offsets.byteswap()
+        tmp_path = filename + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(self.HEADER.pack(self.SIGNATURE, self.VERSION, self.prt_size, self.prt_sha1, len(palette_offsets), self.bitmap_table_offset,
+                    self.num_bitmaps, len(animation_offsets), self.num_optional_entries, self.extra_data_offset))
+            f.write(palette_offsets.tostring())
+            f.write(animation_offsets.tostring())
+        os.rename(tmp_path, filename)
+
+    @classmethod
+    def Load(cls, filename, prt_data):
+        """Reads an index written by Save.  Returns None if the file is missing, unreadable or was made for a PRT other than prt_data."""
+        try:
+            with open(filename, 'rb') as f:
+                data = f.read()
+        except IOError:
+            return None
+        if len(data) < cls.HEADER.size:
+            return None
+        (sig, ver, prt_size, prt_sha1, num_palettes, bitmap_table_offset, num_bitmaps, num_anims, num_optional_entries,
+                extra_data_offset) = cls.HEADER.unpack_from(data)
+        if sig != cls.SIGNATURE or ver != cls.VERSION or len(data) != cls.HEADER.size + (num_palettes + num_anims) * 4:
+            return None
+        # the size check is free; only hash the PRT if it passes
+        if prt_size != len(prt_data) or prt_sha1 != hashlib.sha1(buffer(prt_data)).digest():
+            return None
+        index = cls()
+        index.prt_size = prt_size
+        index.prt_sha1 = prt_sha1
+        index.palette_offsets.fromstring(buffer(data, cls.HEADER.size, num_palettes * 4))
+        index.animation_offsets.fromstring(buffer(data, cls.HEADER.size + num_palettes * 4, num_anims * 4))
+        if sys.byteorder == 'big':
+            index.palette_offsets.byteswap()
+            index.animation_offsets.byteswap()
+        index.bitmap_table_offset = bitmap_table_offset
+        index.num_bitmaps = num_bitmaps
+        index.num_optional_entries = num_optional_entries
+        index.extra_data_offset = extra_data_offset
+        return index
+
+def _BitmapDataSize(record):
+    """Returns the size of the pixel data of a decoded BITMAP_RECORD."""
+    padded_w, offset, h, w, img_type, pal_id = record
+    if img_type in [4, 5]:
+        # Older builds stored the scanline width of an 8bpp row in 1bpp records, but the packed rows always come first
+        return bitmap.RowStride(w, 1) * h
+    return padded_w * h
+
+def _CheckAnimation(anims, anim_id, num_bitmaps):
+    """Raises PRTWriteError if the only animation in AnimationTable anims (animation anim_id of the file) can't be written correctly: a subframe
+    uses a bitmap that doesn't exist, a frame's subframe count or unknown byte is too large (see _BadFrames), or unknown3 doesn't match the
+    appendix rows."""
+    for row, bitmap_id in enumerate(anims.subframe_bitmap_id):
+        if bitmap_id < 0 or bitmap_id >= num_bitmaps:
+            _, frame, subframe = anims.LocateSubframe(row)
+            raise PRTWriteError('animation %d frame %d subframe %d: bitmap_id %d out of range' % (anim_id, frame, subframe, bitmap_id))
+    for row in _BadFrames(anims):
+        raise PRTWriteError(_FrameErrors(anims, row, anim_id)[0])
+    if anims.anim_unknown3[0] != anims.anim_appendix_count[0]:
+        raise PRTWriteError('animation %d: unknown3 (%d) must equal the number of appendix rows (%d)' % (anim_id, anims.anim_unknown3[0],
+                anims.anim_appendix_count[0]))
+
+def _Splice(m, start, old_size, data):
+    """Replaces old_size bytes at start of writable mmap m with data, moving the rest of the file up or down if the size changes."""
+    delta = len(data) - old_size
+    tail = len(m) - (start + old_size)
+    if delta > 0:
+        m.resize(len(m) + delta)
+        m.move(start + len(data), start + old_size, tail)
+    elif delta < 0:
+        m.move(start + len(data), start + old_size, tail)
+        m.resize(len(m) + delta)
+    m[start:start + len(data)] = str(data)
+
 class PRTFile(object):
     def __init__(self, prt_file, bmp_file):
         self._prt_file = prt_file
         self._bmp_file = bmp_file
         self.palettes = []
         self.bitmaps = []
-        self.animations = []
+        self.animations = AnimationTable()
         self.num_optional_entries = 0
         self.extra_data = bytearray()
+        # If set, Write stores bitmaps with identical pixel data (and size/type) only once, and records how much that saved
+        self.dedup_bitmaps = False
+        self.dedup_bytes_saved = 0
+        self._bmp_map = None
+        self._prt_data = ''
+        self._prt_pos = 0
+        # random access state (see Open); the lock serializes use of the shared decode position
+        self.index = None
+        self._index_filename = None
+        self._writable = False
+        self._bmp_data_start = 0
+        self._palette_cache = {}
+        self._lock = threading.Lock()
+        # Load and Write time their phases with this (see metrics.MetricsRecorder)
+        self.metrics = metrics.NullRecorder()
 
-    def _ReadAndUnpack(self, fmt):
-        s = struct.Struct(fmt)
-        data = self._prt_file.read(s.size)
-        if len(data) != s.size:
-            raise PRTLoadError('ran out of data: expected %d bytes, got %d' % (s.size, len(data)))
-        return s.unpack(data)
+    @property
+    def animations(self):
+        """The animation table (an AnimationTable).  A list of animation dicts may be assigned and will be converted."""
+        return self._animations
+
+    @animations.setter
+    def animations(self, value):
+        if not isinstance(value, AnimationTable):
+            value = AnimationTable(value)
+        self._animations = value
+
+    def _ReadAndUnpack(self, s):
+        """Decodes Struct s at the current position of the PRT buffer and advances past it."""
+        available = len(self._prt_data) - self._prt_pos
+        if available < s.size:
+            raise PRTLoadError('ran out of data: expected %d bytes, got %d' % (s.size, max(available, 0)))
+        values = s.unpack_from(self._prt_data, self._prt_pos)
+        self._prt_pos += s.size
+        return values
+
+    def _ReadRun(self, record, count):
+        """Decodes count consecutive records of Struct record in one call, returning a flat tuple of their fields."""
+        available = len(self._prt_data) - self._prt_pos
+        if available < record.size * count:
+            # checked up front so a corrupt count can't build an enormous Struct
+            raise PRTLoadError('ran out of data: expected %d bytes, got %d' % (record.size * count, max(available, 0)))
+        return self._ReadAndUnpack(_RunStruct(record, count))
+
+    def _LoadPalette(self):
+        """Decodes the palette at the current position of the PRT buffer."""
+        # Each palette consists of a PPAL section (1048 bytes), followed by a head section (4), then a data section (1024, i.e. 256 * 4 for each color)
+        pal = palette.Palette()
+        num_tags_left = 2
+        while num_tags_left > 0:
+            num_tags_left = num_tags_left - 1
+            tag, section_size = self._ReadAndUnpack(SECTION_HEADER)
+            if tag == 'PPAL':
+                if section_size != 1048:
+                    raise PRTLoadError('Unexpected PPAL size (%d != 1048)' % section_size)
+            elif tag == 'RIFF':
+                # TODO: we could probably support these
+                raise PRTLoadError('RIFF tag not implemented')
+            elif tag == 'head':
+                if section_size != 4:
+                    raise PRTLoadError('Unexpected head size (%d != 4)' % section_size)
+                num_tags_left, = self._ReadAndUnpack(UINT32)
+            elif tag == 'data':
+                if section_size != 1024:
+                    raise PRTLoadError('Unexpected data size (%d != 1024)' % section_size)
+                entries, = self._ReadAndUnpack(PALETTE_DATA)
+                # Note that the blue and red channels appear to be swapped for some reason
+                pal.data.extend(palette.SwapRedBlue(entries))
+            else:
+                raise PRTLoadError('unhandled tag: %s (size=%d)' % (tag, section_size))
+        return pal
 
     def _LoadPalettes(self):
         """Loads the palette information ('CPAL' format)."""
         # Header (4 bytes 'CPAL' section tag plus 4 bytes number of palettes)
-        tag, num_palettes = self._ReadAndUnpack('<4s I')
+        tag, num_palettes = self._ReadAndUnpack(SECTION_HEADER)
         if tag != 'CPAL':
             raise PRTLoadError('PRT signature was not CPAL')
-        # Each palette consists of a PPAL section (1048 bytes), followed by a head section (4), then a data section (1024, i.e. 256 * 4 for each color)
         for i in xrange(num_palettes):
-            pal = palette.Palette()
-            num_tags_left = 2
-            while num_tags_left > 0:
-                num_tags_left = num_tags_left - 1
-                tag, section_size = self._ReadAndUnpack('<4s I')
-                if tag == 'PPAL':
-                    if section_size != 1048:
-                        raise PRTLoadError('Unexpected PPAL size (%d != 1048)' % section_size)
-                elif tag == 'RIFF':
-                    # TODO: we could probably support these
-                    raise PRTLoadError('RIFF tag not implemented')
-                elif tag == 'head':
-                    if section_size != 4:
-                        raise PRTLoadError('Unexpected head size (%d != 4)' % section_size)
-                    num_tags_left, = self._ReadAndUnpack('<I')
-                elif tag == 'data':
-                    if section_size != 1024:
-                        raise PRTLoadError('Unexpected data size (%d != 1024)' % section_size)
-                    for j in xrange(256):
-                        entry = self._ReadAndUnpack('<4B')
-                        # Note that the blue and red channels appear to be swapped for some reason
-                        pal.colors.append(palette.Color(r=entry[2], g=entry[1], b=entry[0], flags=entry[3]))
-                else:
-                    raise PRTLoadError('unhandled tag: %s (size=%d)' % (tag, section_size))
-            self.palettes.append(pal)
+            self.palettes.append(self._LoadPalette())
 
-    def _WritePalettes(self):
-        """Writes the palette information ('CPAL' format)."""
+    def _WritePalettes(self, out):
+        """Writes the palette information ('CPAL' format) to _BatchWriter out."""
         # Write the CPAL header
-        self._prt_file.write(struct.pack('<4s I', 'CPAL', len(self.palettes)))
+        out.Pack(SECTION_HEADER, 'CPAL', len(self.palettes))
         # Write each PPAL section
         # Each palette consists of a PPAL section (1048 bytes), followed by a head section (4), then a data section (1024, i.e. 256 * 4 for each color)
         for pal in self.palettes:
-            # PPAL
-            self._prt_file.write(struct.pack('<4s I', 'PPAL', 1048))
-            # head
-            self._prt_file.write(struct.pack('<4s I I', 'head', 4, 1))
-            # data
-            self._prt_file.write(struct.pack('<4s I', 'data', 1024))
-            for color in pal.colors:
-                self._prt_file.write(struct.pack('<4B', color.b, color.g, color.r, color.flags))
-
-    def _LoadBitmaps(self):
-        """Loads the bitmap data (metadata + raw pixel data in bmp file)."""
-        buf = self._bmp_file.read(14)
+            out.Pack(PALETTE_SECTIONS, 'PPAL', 1048, 'head', 4, 1, 'data', 1024)
+            out.Write(palette.SwapRedBlue(pal.data))
+
+    def _ReadBMPHeader(self):
+        """Checks the bmp file header and returns the offset of the image data."""
+        if self._bmp_map is not None:
+            buf = self._bmp_map[:14]
+        else:
+            buf = self._bmp_file.read(14)
+        if len(buf) != 14:
+            raise PRTLoadError('OP2_ART.BMP is not a valid BMP file')
         signature, _, _, _, data_start = struct.unpack('<2s I hh I', buf)
         if signature != 'BM':
             raise PRTLoadError('OP2_ART.BMP is not a valid BMP file')
-        num_bitmaps, = self._ReadAndUnpack('<I')
+        return data_start
+
+    def _LoadBitmap(self, pal, record, data_start):
+        """Returns the bitmap for a decoded BITMAP_RECORD, using palette pal and reading its pixel data from the bmp file."""
+        padded_w, offset, h, w, img_type, pal_id = record
+        bmp = bitmap.Bitmap()
+        bmp.palette = pal
+        bmp.palette_id = pal_id
+        bmp.image_type = img_type
+        bmp.width = w
+        bmp.height = h
+        size = _BitmapDataSize(record)
+        if self._bmp_map is not None:
+            # zero-copy view of the bitmap data (offset is relative to the start of the actual image data)
+            bmp.data = buffer(self._bmp_map, offset + data_start, size)
+        else:
+            # seek to the offset (relative to the start of the actual image data) and read the bitmap data
+            self._bmp_file.seek(offset + data_start)
+            bmp.data = bytearray(self._bmp_file.read(size))
+        return bmp
+
+    def _LoadBitmaps(self, mmap_bitmaps=False):
+        """Loads the bitmap data (metadata + raw pixel data in bmp file).
+
+        If mmap_bitmaps is set, the bmp file is memory-mapped and each bitmap's data is a read-only view into the mapping instead of a copy (see
+        Bitmap.MutableData).
+        """
+        if mmap_bitmaps:
+            self._bmp_map = mmap.mmap(self._bmp_file.fileno(), 0, access=mmap.ACCESS_READ)
+        data_start = self._bmp_data_start = self._ReadBMPHeader()
+        num_bitmaps, = self._ReadAndUnpack(UINT32)
         for i in xrange(num_bitmaps):
-            padded_w, offset, h, w, img_type, pal_id = self._ReadAndUnpack('<IIIIhh')
+            record = self._ReadAndUnpack(BITMAP_RECORD)
+            pal_id = record[5]
             if pal_id < 0 or pal_id > len(self.palettes) - 1:
                 raise PRTLoadError('bitmap %d: palette_id %d out of range' % (i, pal_id))
-            bmp = bitmap.Bitmap()
-            bmp.palette = self.palettes[pal_id]
-            bmp.palette_id = pal_id
-            bmp.image_type = img_type
-            bmp.width = w
-            bmp.height = h
-            # seek to the offset (relative to the start of the actual image data) and read the bitmap data
-            self._bmp_file.seek(offset + data_start)
-            bmp.data = bytearray(self._bmp_file.read(padded_w * h))
-            self.bitmaps.append(bmp)
+            self.bitmaps.append(self._LoadBitmap(self.palettes[pal_id], record, data_start))
 
-    def _WriteBitmaps(self):
-        """Writes the bitmap data to the bmp file."""
-        # Create one master bitmap and palette (the headers and palette info are totally ignored, the .bmp file is a glorified data buffer)
+    def _WriteBitmaps(self, out):
+        """Writes the bitmap metadata to _BatchWriter out and streams the bitmap data to the bmp file.  Returns the size of the bitmap data."""
+        # One master bitmap and palette (the headers and palette info are totally ignored, the .bmp file is a glorified data buffer)
         master_bmp = bitmap.Bitmap()
         master_bmp.palette = palette.Palette()
-        for i in xrange(256):
-            master_bmp.palette.colors.append(palette.Color(r=0, g=0, b=0, flags=0))
+        master_bmp.palette.data = bytearray(256 * 4)
 
-        # Write the bitmap metadata to the prt file
-        self._prt_file.write(struct.pack('<I', len(self.bitmaps)))
+        # Write the bitmap metadata to the prt file, working out the offsets as we go.  When deduplicating, bitmaps whose pixel data has already been
+        # stored just point at the earlier copy (the records have an explicit offset, so the game doesn't care).
+        out.Pack(UINT32, len(self.bitmaps))
+        offset = 0
+        stored = []
+        seen = {}
+        self.dedup_bytes_saved = 0
         for bmp in self.bitmaps:
-            # TODO: sanity check the metadata here, like making sure it uses a valid palette ID, etc.
-            padded_width = (bmp.width + 3) & ~3
-            self._prt_file.write(struct.pack('<IIIIhh', padded_width, len(master_bmp.data), bmp.height, bmp.width, bmp.image_type, bmp.palette_id))
-            master_bmp.data.extend(bmp.data)
-        master_bmp.WriteBMPToOpenFile(self._bmp_file)
-
-    def Load(self):
-        self._LoadPalettes()
-        self._LoadBitmaps()
-        num_anims, = self._ReadAndUnpack('<I')
-        num_frames, = self._ReadAndUnpack('<I')
-        num_subframes, = self._ReadAndUnpack('<I')
-        self.num_optional_entries, = self._ReadAndUnpack('<I')
-        num_loaded_frames = 0
-        num_loaded_subframes = 0
-        # animations
-        for i in xrange(num_anims):
-            unk1, left, top, right, bottom, x_off, y_off, unk2, frames = self._ReadAndUnpack('<IIIIIIIII')
-            animation = {
-                'unknown1': unk1,
-                'bounding_box': Rect(left=left, top=top, right=right, bottom=bottom),
-                'offset': Point(x=x_off, y=y_off),
-                'unknown2': unk2,
-                'frames': [],
-                'appendix': []
-            }
-            # frames
-            for j in xrange(frames):
-                subframes, unknown = self._ReadAndUnpack('<BB')
-                optional1 = None
-                optional2 = None
-                optional3 = None
-                optional4 = None
-                if subframes & 0x80:
-                    subframes = subframes & 0x7F
-                    optional1, optional2 = self._ReadAndUnpack('<2B')
-                if unknown & 0x80:
-                    unknown = unknown & 0x7F
-                    optional3, optional4 = self._ReadAndUnpack('<2B')
-                frame_data = {
-                    'subframes': [],
-                    'unknown': unknown,
-                    'optional1': optional1,
-                    'optional2': optional2,
-                    'optional3': optional3,
-                    'optional4': optional4
-                }
-                # subframes
-                for k in xrange(subframes):
-                    bitmap_id, unk1, subframe_id, x_off, y_off = self._ReadAndUnpack('<hBBhh')
-                    subframe_data = {
-                        'bitmap_id': bitmap_id,
-                        'unknown': unk1,
-                        'subframe_id': subframe_id,
-                        'offset': Point(x=x_off, y=y_off),
-                    }
-                    frame_data['subframes'].append(subframe_data)
-                    num_loaded_subframes = num_loaded_subframes + 1
-                animation['frames'].append(frame_data)
-                num_loaded_frames = num_loaded_frames + 1
-            unk3, = self._ReadAndUnpack('<I')
-            animation['unknown3'] = unk3
-            # "appendix"
-            for j in xrange(unk3):
-                appendix_info = self._ReadAndUnpack('<4I')
-                animation['appendix'].append(list(appendix_info))
-            self.animations.append(animation)
+            bmp_offset = None
+            if self.dedup_bitmaps:
+                key = (bmp.width, bmp.height, bmp.image_type, hashlib.sha1(bmp.data).digest())
+                match = seen.get(key)
+                if match is not None and match[1].data == bmp.data:
+                    bmp_offset = match[0]
+                    self.dedup_bytes_saved = self.dedup_bytes_saved + len(bmp.data)
+                else:
+                    seen[key] = (offset, bmp)
+            if bmp_offset is None:
+                bmp_offset = offset
+                offset = offset + len(bmp.data)
+                stored.append(bmp)
+            out.Pack(BITMAP_RECORD, bmp.Stride(), bmp_offset, bmp.height, bmp.width, bmp.image_type, bmp.palette_id)
+        # Then stream the pixel data straight after the master bitmap's headers
+        master_bmp.WriteBMPHeaderToOpenFile(self._bmp_file, offset)
+        for bmp in stored:
+            self._bmp_file.write(bmp.data)
+        return offset
+
+    def _LoadAnimation(self, anims):
+        """Decodes the animation at the current position of the PRT buffer into AnimationTable anims.  Returns its number of frames and subframes."""
+        unk1, left, top, right, bottom, x_off, y_off, unk2, frames = self._ReadAndUnpack(ANIMATION_RECORD)
+        anim = anims.AddAnimation(unk1, (left, top, right, bottom), (x_off, y_off), unk2)
+        num_subframes = 0
+        # frames
+        for j in xrange(frames):
+            subframes, unknown = self._ReadAndUnpack(FRAME_HEADER)
+            optional1 = None
+            optional2 = None
+            optional3 = None
+            optional4 = None
+            if subframes & 0x80:
+                subframes = subframes & 0x7F
+                optional1, optional2 = self._ReadAndUnpack(FRAME_OPTIONAL)
+            if unknown & 0x80:
+                unknown = unknown & 0x7F
+                optional3, optional4 = self._ReadAndUnpack(FRAME_OPTIONAL)
+            frame = anims.AddFrame(anim, unknown, optional1, optional2, optional3, optional4)
+            # subframes (decoded as one run)
+            anims.AddSubframes(frame, self._ReadRun(SUBFRAME_RECORD, subframes))
+            num_subframes = num_subframes + subframes
+        unk3, = self._ReadAndUnpack(UINT32)
+        anims.anim_unknown3[anim] = unk3
+        # "appendix" (decoded as one run)
+        anims.SetAppendix(anim, self._ReadRun(APPENDIX_RECORD, unk3))
+        return frames, num_subframes
+
+    def _Skip(self, size):
+        """Advances past size bytes of the PRT buffer without decoding them."""
+        available = len(self._prt_data) - self._prt_pos
+        if available < size:
+            raise PRTLoadError('ran out of data: expected %d bytes, got %d' % (size, max(available, 0)))
+        self._prt_pos += size
+
+    def _SkipAnimation(self):
+        """Advances past the animation at the current position of the PRT buffer, only decoding the counts needed to find its end."""
+        frames = self._ReadAndUnpack(ANIMATION_RECORD)[8]
+        for j in xrange(frames):
+            subframes, unknown = self._ReadAndUnpack(FRAME_HEADER)
+            size = (subframes & 0x7F) * SUBFRAME_RECORD.size
+            if subframes & 0x80:
+                size = size + FRAME_OPTIONAL.size
+            if unknown & 0x80:
+                size = size + FRAME_OPTIONAL.size
+            self._Skip(size)
+        unk3, = self._ReadAndUnpack(UINT32)
+        self._Skip(unk3 * APPENDIX_RECORD.size)
+
+    def _SnapshotLayout(self):
+        """Returns a hash of everything the snapshot layout depends on besides SNAPSHOT_VERSION."""
+        return hashlib.sha1(repr((AnimationTable.COLUMNS, PALETTE_DATA.format, BITMAP_RECORD.format))).digest()
+
+    def _EncodeSnapshot(self, bitmap_table):
+        """Returns a snapshot of the loaded data.  bitmap_table is the bitmap records as stored in the PRT."""
+        f = cStringIO.StringIO()
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_SIGNATURE, SNAPSHOT_VERSION, self._SnapshotLayout(), self.num_optional_entries,
+                self._bmp_data_start, len(self.palettes), len(self.bitmaps)))
+        for pal in self.palettes:
+            f.write(pal.data)
+        f.write(bitmap_table)
+        self.animations.Serialize(f)
+        f.write(UINT32.pack(len(self.extra_data)))
+        f.write(self.extra_data)
+        return f.getvalue()
+
+    def _LoadSnapshot(self, data, mmap_bitmaps):
+        """Loads everything from a snapshot written by _EncodeSnapshot, reading the pixel data from the bmp file.  Returns False (and loads
+        nothing) if the snapshot was written by another version or is damaged."""
+        if len(data) < SNAPSHOT_HEADER.size:
+            return False
+        signature, version, layout, num_optional_entries, data_start, num_palettes, num_bitmaps = SNAPSHOT_HEADER.unpack_from(data)
+        if signature != SNAPSHOT_SIGNATURE or version != SNAPSHOT_VERSION or layout != self._SnapshotLayout():
+            return False
+        offset = SNAPSHOT_HEADER.size
+        table = offset + num_palettes * PALETTE_DATA.size
+        anims_start = table + num_bitmaps * BITMAP_RECORD.size
+        if anims_start > len(data):
+            return False
+        try:
+            animations, offset = AnimationTable.Deserialize(data, anims_start)
+        except ValueError:
+            return False
+        if offset + UINT32.size > len(data):
+            return False
+        extra_size, = UINT32.unpack_from(data, offset)
+        offset = offset + UINT32.size
+        if offset + extra_size != len(data):
+            return False
+        palettes = []
+        for i in xrange(num_palettes):
+            pal = palette.Palette()
+            pal.data = bytearray(buffer(data, SNAPSHOT_HEADER.size + i * PALETTE_DATA.size, PALETTE_DATA.size))
+            palettes.append(pal)
+        if mmap_bitmaps:
+            self._bmp_map = mmap.mmap(self._bmp_file.fileno(), 0, access=mmap.ACCESS_READ)
+        records = _RunStruct(BITMAP_RECORD, num_bitmaps).unpack_from(data, table) if num_bitmaps else ()
+        bitmaps = []
+        for i in xrange(num_bitmaps):
+            record = records[i * 6:i * 6 + 6]
+            bitmaps.append(self._LoadBitmap(palettes[record[5]], record, data_start))
+        self.num_optional_entries = num_optional_entries
+        self._bmp_data_start = data_start
+        self.palettes = palettes
+        self.bitmaps = bitmaps
+        self.animations = animations
+        self.extra_data = bytearray(buffer(data, offset, extra_size))
+        return True
+
+    def Load(self, mmap_bitmaps=False, snapshot_cache=None):
+        """Decodes the PRT file and reads the bitmaps from the bmp file (as views into a memory mapping if mmap_bitmaps is set, see _LoadBitmaps).
+
+        If snapshot_cache (a snapshot_cache.SnapshotCache) is given, everything except the pixel data is restored from its snapshot of these
+        files, if it has an up to date one, instead of being decoded.  Otherwise a snapshot is stored after decoding.
+        """
+        if snapshot_cache is not None:
+            with self.metrics.Phase('prt.load_snapshot') as phase:
+                snapshot = snapshot_cache.Lookup(self._prt_file, self._bmp_file)
+                if snapshot is not None and self._LoadSnapshot(snapshot, mmap_bitmaps):
+                    phase.bytes = len(snapshot)
+                    phase.records = len(self.palettes) + len(self.bitmaps) + len(self.animations)
+                    return
+        # The PRT is read into a single buffer and decoded in place
+        with self.metrics.Phase('prt.read') as phase:
+            self._prt_data = self._prt_file.read()
+            phase.bytes = len(self._prt_data)
+        self._prt_pos = 0
+        with self.metrics.Phase('prt.load_palettes') as phase:
+            self._LoadPalettes()
+            phase.bytes = self._prt_pos
+            phase.records = len(self.palettes)
+        with self.metrics.Phase('prt.load_bitmaps') as phase:
+            start = self._prt_pos
+            self._LoadBitmaps(mmap_bitmaps)
+            # the bitmap records follow their count
+            bitmap_table = buffer(self._prt_data, start + UINT32.size, len(self.bitmaps) * BITMAP_RECORD.size)
+            # the records plus the pixel data read from (or mapped in) the bmp file
+            phase.bytes = self._prt_pos - start + sum(len(b.data) for b in self.bitmaps)
+            phase.records = len(self.bitmaps)
+        with self.metrics.Phase('prt.load_animations') as phase:
+            start = self._prt_pos
+            num_anims, num_frames, num_subframes, self.num_optional_entries = self._ReadRun(UINT32, 4)
+            num_loaded_frames = 0
+            num_loaded_subframes = 0
+            for i in xrange(num_anims):
+                frames, subframes = self._LoadAnimation(self.animations)
+                num_loaded_frames = num_loaded_frames + frames
+                num_loaded_subframes = num_loaded_subframes + subframes
+            phase.bytes = self._prt_pos - start
+            phase.records = num_anims + num_loaded_frames + num_loaded_subframes
         if len(self.animations) != num_anims:
-            raise PRTLoadError('incorrect number of animations loaded (%d, expected %d)' % (num_loaded_anims, num_anims))
+            raise PRTLoadError('incorrect number of animations loaded (%d, expected %d)' % (len(self.animations), num_anims))
         if num_loaded_frames != num_frames:
             raise PRTLoadError('incorrect number of frames loaded (%d, expected %d)' % (num_loaded_frames, num_frames))
         if num_loaded_subframes != num_subframes:
             raise PRTLoadError('incorrect number of subframes loaded (%d, expected %d)' % (num_loaded_subframes, num_subframes))
-        # Read any data from the end of the PRT that is left
-        self.extra_data.extend(self._prt_file.read())
+        # Keep any data from the end of the PRT that is left
+        self.extra_data.extend(buffer(self._prt_data, self._prt_pos))
+        if snapshot_cache is not None:
+            with self.metrics.Phase('prt.store_snapshot'):
+                snapshot_cache.Store(self._prt_file, self._bmp_file, self._EncodeSnapshot(bitmap_table))
+        self._prt_data = ''
+        self._prt_pos = 0
+
+    def _BuildIndex(self):
+        """Walks the PRT buffer once, recording where each record starts.  Returns a PRTIndex."""
+        index = PRTIndex()
+        self._prt_pos = 0
+        tag, num_palettes = self._ReadAndUnpack(SECTION_HEADER)
+        if tag != 'CPAL':
+            raise PRTLoadError('PRT signature was not CPAL')
+        for i in xrange(num_palettes):
+            index.palette_offsets.append(self._prt_pos)
+            self._LoadPalette()
+        index.num_bitmaps, = self._ReadAndUnpack(UINT32)
+        index.bitmap_table_offset = self._prt_pos
+        self._Skip(index.num_bitmaps * BITMAP_RECORD.size)
+        num_anims, _, _, index.num_optional_entries = self._ReadRun(UINT32, 4)
+        for i in xrange(num_anims):
+            index.animation_offsets.append(self._prt_pos)
+            self._SkipAnimation()
+        index.extra_data_offset = self._prt_pos
+        index.prt_size = len(self._prt_data)
+        index.prt_sha1 = hashlib.sha1(buffer(self._prt_data)).digest()
+        return index
+
+    def Open(self, index_filename=None, writable=False):
+        """Prepares the files for random access through GetPalette/GetBitmap/GetAnimation, instead of decoding everything with Load.
+
+        Both files are memory-mapped, and finding the records takes one pass over the PRT that skips over anything it doesn't need to decode.  If
+        index_filename is given, the offset index is read from that sidecar file when it still matches the PRT, and (re)written otherwise.
+
+        If writable is set (the files must have been opened for update, i.e. 'r+b'), ReplaceBitmap and ReplaceAnimation can patch the files.
+        """
+        access = mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ
+        self._prt_data = mmap.mmap(self._prt_file.fileno(), 0, access=access)
+        self._bmp_map = mmap.mmap(self._bmp_file.fileno(), 0, access=access)
+        self._writable = writable
+        self._index_filename = index_filename
+        self._bmp_data_start = self._ReadBMPHeader()
+        self.index = None
+        if index_filename:
+            self.index = PRTIndex.Load(index_filename, self._prt_data)
+        if self.index is None:
+            self.index = self._BuildIndex()
+            if index_filename:
+                self.index.Save(index_filename)
+        self.num_optional_entries = self.index.num_optional_entries
+        self._palette_cache = {}
+
+    def GetPalette(self, i):
+        """Decodes palette i (see Open).  Palettes are cached, so bitmaps sharing a palette share the object, as they do after Load."""
+        with self._lock:
+            return self._GetPalette(i)
+
+    def _GetPalette(self, i):
+        pal = self._palette_cache.get(i)
+        if pal is None:
+            if i < 0 or i >= len(self.index.palette_offsets):
+                raise IndexError('palette %d out of range' % i)
+            self._prt_pos = self.index.palette_offsets[i]
+            pal = self._palette_cache[i] = self._LoadPalette()
+        return pal
+
+    def GetBitmap(self, i):
+        """Decodes bitmap i and its palette (see Open).  The pixel data is a read-only view into the memory-mapped bmp file."""
+        with self._lock:
+            if i < 0 or i >= self.index.num_bitmaps:
+                raise IndexError('bitmap %d out of range' % i)
+            self._prt_pos = self.index.bitmap_table_offset + i * BITMAP_RECORD.size
+            record = self._ReadAndUnpack(BITMAP_RECORD)
+            pal_id = record[5]
+            if pal_id < 0 or pal_id >= len(self.index.palette_offsets):
+                raise PRTLoadError('bitmap %d: palette_id %d out of range' % (i, pal_id))
+            return self._LoadBitmap(self._GetPalette(pal_id), record, self._bmp_data_start)
+
+    def GetAnimation(self, i):
+        """Decodes animation i (see Open), returning an AnimationView into a table holding just that animation."""
+        with self._lock:
+            if i < 0 or i >= len(self.index.animation_offsets):
+                raise IndexError('animation %d out of range' % i)
+            anims = AnimationTable()
+            self._prt_pos = self.index.animation_offsets[i]
+            self._LoadAnimation(anims)
+            return anims[0]
 
-    def Write(self):
-        self._WritePalettes()
-        self._WriteBitmaps()
+    def _Patched(self):
+        """Writes out the changes made by a Replace method, and brings the sidecar index up to date."""
+        self._prt_data.flush()
+        self._bmp_map.flush()
+        self.index.prt_size = len(self._prt_data)
+        if self._index_filename:
+            self.index.prt_sha1 = hashlib.sha1(buffer(self._prt_data)).digest()
+            self.index.Save(self._index_filename)
+
+    def ReplaceBitmap(self, i, bmp):
+        """Replaces bitmap i (size, image type, palette ID and pixel data) in files opened with Open(writable=True).  Returns True if it was done
+        in place.
+
+        If the new pixel data is the same size as the old, it is overwritten in place.  Otherwise the rest of the bmp file is moved to make room, and
+        the offsets of the bitmaps stored after it are updated.  Data that is shared with other bitmaps (see dedup_bitmaps) is left alone and the
+        new data is added at the end instead.  Views returned by earlier GetBitmap calls are invalid afterwards.
+        """
+        with self._lock:
+            if not self._writable:
+                raise ValueError('the files were not opened for patching')
+            if i < 0 or i >= self.index.num_bitmaps:
+                raise IndexError('bitmap %d out of range' % i)
+            if bmp.palette_id < 0 or bmp.palette_id >= len(self.index.palette_offsets):
+                raise ValueError('palette_id %d out of range' % bmp.palette_id)
+            size = bmp.Stride() * bmp.height
+            if len(bmp.data) != size:
+                raise ValueError('expected %d bytes of pixel data for a %dx%d image of type %d, got %d' % (size, bmp.width, bmp.height,
+                        bmp.image_type, len(bmp.data)))
+            table = self.index.bitmap_table_offset
+            records = [BITMAP_RECORD.unpack_from(self._prt_data, table + j * BITMAP_RECORD.size) for j in xrange(self.index.num_bitmaps)]
+            old_offset = records[i][1]
+            old_size = _BitmapDataSize(records[i])
+            shared = any(j != i and r[1] < old_offset + old_size and old_offset < r[1] + _BitmapDataSize(r) for j, r in enumerate(records))
+            data_start = self._bmp_data_start
+            if shared:
+                offset = len(self._bmp_map) - data_start
+                _Splice(self._bmp_map, len(self._bmp_map), 0, bmp.data)
+            else:
+                offset = old_offset
+                _Splice(self._bmp_map, data_start + old_offset, old_size, bmp.data)
+                delta = size - old_size
+                if delta:
+                    for j, r in enumerate(records):
+                        # everything stored after the old pixels, including data that starts at old_offset if they were empty
+                        if j != i and r[1] >= old_offset + old_size:
+                            BITMAP_RECORD.pack_into(self._prt_data, table + j * BITMAP_RECORD.size, r[0], r[1] + delta, *r[2:])
+            # BITMAPFILEHEADER file size
+            UINT32.pack_into(self._bmp_map, 2, len(self._bmp_map))
+            BITMAP_RECORD.pack_into(self._prt_data, table + i * BITMAP_RECORD.size, bmp.Stride(), offset, bmp.height, bmp.width, bmp.image_type,
+                    bmp.palette_id)
+            self._Patched()
+            return not shared and size == old_size
+
+    def ReplaceAnimation(self, i, anim):
+        """Replaces animation i with anim (an AnimationView, e.g. from GetAnimation, or an animation dict) in files opened with Open(writable=True).
+        Returns True if it was done in place.
+
+        If the encoded animation is the same size as the old one, it is overwritten in place.  Otherwise the rest of the PRT is moved to make room.
+        The frame and subframe totals in the animation table header are updated either way.  Raises PRTWriteError, leaving the files untouched,
+        if anim can't be written correctly (see Validate).
+        """
+        with self._lock:
+            if not self._writable:
+                raise ValueError('the files were not opened for patching')
+            offsets = self.index.animation_offsets
+            if i < 0 or i >= len(offsets):
+                raise IndexError('animation %d out of range' % i)
+            # nothing may be touched before this, since the files are patched in place
+            new = AnimationTable()
+            new.append(anim, anim_id=i)
+            _CheckAnimation(new, i, self.index.num_bitmaps)
+            f = cStringIO.StringIO()
+            out = _BatchWriter(f)
+            self._WriteAnimation(out, new, 0)
+            out.Flush()
+            data = f.getvalue()
+            start = offsets[i]
+            end = offsets[i + 1] if i + 1 < len(offsets) else self.index.extra_data_offset
+            self._prt_pos = start
+            old_frames, old_subframes = self._LoadAnimation(AnimationTable())
+            header = self.index.bitmap_table_offset + self.index.num_bitmaps * BITMAP_RECORD.size
+            num_anims, num_frames, num_subframes, num_optional_entries = _RunStruct(UINT32, 4).unpack_from(self._prt_data, header)
+            _RunStruct(UINT32, 4).pack_into(self._prt_data, header, num_anims, num_frames - old_frames + new.NumFrames(),
+                    num_subframes - old_subframes + new.NumSubframes(), num_optional_entries)
+            _Splice(self._prt_data, start, end - start, data)
+            delta = len(data) - (end - start)
+            if delta:
+                for j in xrange(i + 1, len(offsets)):
+                    offsets[j] += delta
+                self.index.extra_data_offset += delta
+            self._Patched()
+            return delta == 0
+
+    def _WriteAnimations(self, out):
+        """Writes the animation table to _BatchWriter out."""
         # number of animations, frames, subframes, optional entries
+        anims = self.animations
+        out.Pack(_RunStruct(UINT32, 4), len(anims), anims.NumFrames(), anims.NumSubframes(), self.num_optional_entries)
+
+        # animations (serialized straight from the table columns)
+        for i in xrange(len(anims)):
+            self._WriteAnimation(out, anims, i)
+
+    def _WriteAnimation(self, out, anims, i):
+        """Writes animation i of AnimationTable anims to _BatchWriter out."""
+        out.Pack(ANIMATION_RECORD, anims.anim_unknown1[i], anims.anim_left[i], anims.anim_top[i], anims.anim_right[i], anims.anim_bottom[i],
+                anims.anim_x[i], anims.anim_y[i], anims.anim_unknown2[i], anims.anim_frame_count[i])
+        # frames
+        start = anims.anim_frame_start[i]
+        for f in xrange(start, start + anims.anim_frame_count[i]):
+            subframes = anims.frame_subframe_count[f]
+            unknown = anims.frame_unknown[f]
+            opt1 = anims.frame_optional1[f]
+            opt2 = anims.frame_optional2[f]
+            opt3 = anims.frame_optional3[f]
+            opt4 = anims.frame_optional4[f]
+            if opt1 != NO_OPTIONAL or opt2 != NO_OPTIONAL:
+                subframes = subframes | 0x80
+            if opt3 != NO_OPTIONAL or opt4 != NO_OPTIONAL:
+                unknown = unknown | 0x80
+            out.Pack(FRAME_HEADER, subframes, unknown)
+            if opt1 != NO_OPTIONAL or opt2 != NO_OPTIONAL:
+                out.Pack(FRAME_OPTIONAL, opt1, opt2)
+            if opt3 != NO_OPTIONAL or opt4 != NO_OPTIONAL:
+                out.Pack(FRAME_OPTIONAL, opt3, opt4)
+            # subframes (packed as one run)
+            a = anims.frame_subframe_start[f]
+            b = a + anims.frame_subframe_count[f]
+            out.Pack(_RunStruct(SUBFRAME_RECORD, b - a), *itertools.chain.from_iterable(itertools.izip(anims.subframe_bitmap_id[a:b],
+                    anims.subframe_unknown[a:b], anims.subframe_id[a:b], anims.subframe_x[a:b], anims.subframe_y[a:b])))
+        out.Pack(UINT32, anims.anim_unknown3[i])
+        # "appendix"
+        ap_start = anims.anim_appendix_start[i] * 4
+        out.Pack(_RunStruct(APPENDIX_RECORD, anims.anim_appendix_count[i]), *anims.appendix[ap_start:ap_start + anims.anim_appendix_count[i] * 4])
+
+    def _WriteAnimationStream(self, out, animations):
+        """Writes the animation table to _BatchWriter out from an iterable of animations, one at a time.  The counts in the header are only known
+        at the end, so they are filled in afterwards, which needs a seekable PRT file.  Returns the number of animations, frames and subframes."""
+        out.Flush()
+        header = self._prt_file.tell()
+        out.Pack(_RunStruct(UINT32, 4), 0, 0, 0, self.num_optional_entries)
+        num_bitmaps = len(self.bitmaps)
+        num_anims = 0
         num_frames = 0
         num_subframes = 0
-        for anim in self.animations:
-            num_frames = num_frames + len(anim['frames'])
-            for frame in anim['frames']:
-                num_subframes = num_subframes + len(frame['subframes'])
-        self._prt_file.write(struct.pack('<I', len(self.animations)))
-        self._prt_file.write(struct.pack('<I', num_frames))
-        self._prt_file.write(struct.pack('<I', num_subframes))
-        self._prt_file.write(struct.pack('<I', self.num_optional_entries))
-
-        # animations
-        for anim in self.animations:
-            bbox = anim['bounding_box']
-            off = anim['offset']
-            self._prt_file.write(struct.pack('<IIIIIIIII', anim['unknown1'], bbox.left, bbox.top, bbox.right, bbox.bottom, off.x, off.y, anim['unknown2'],
-                    len(anim['frames'])))
-            # frames
-            for frame in anim['frames']:
-                subframes = len(frame['subframes'])
-                unknown = frame['unknown']
-                opt1 = frame['optional1']
-                opt2 = frame['optional2']
-                opt3 = frame['optional3']
-                opt4 = frame['optional4']
-                if opt1 is not None or opt2 is not None:
-                    subframes = subframes | 0x80
-                if opt3 is not None or opt4 is not None:
-                    unknown = unknown | 0x80
-                self._prt_file.write(struct.pack('<BB', subframes, unknown))
-                if opt1 is not None or opt2 is not None:
-                    self._prt_file.write(struct.pack('<2B', int(opt1), int(opt2)))
-                if opt3 is not None or opt4 is not None:
-                    self._prt_file.write(struct.pack('<2B', int(opt3), int(opt4)))
-                # subframes
-                for sf in frame['subframes']:
-                    self._prt_file.write(struct.pack('<hBBhh', sf['bitmap_id'], sf['unknown'], sf['subframe_id'], sf['offset'].x, sf['offset'].y))
-            self._prt_file.write(struct.pack('<I', anim['unknown3']))
-            # "appendix"
-            for ap in anim['appendix']:
-                # TODO: sanity check that the appendix list is 4 entries long
-                self._prt_file.write(struct.pack('<4I', ap[0], ap[1], ap[2], ap[3]))
-        # extra data
-        self._prt_file.write(self.extra_data)
+        for anim in animations:
+            anims = AnimationTable()
+            anims.append(anim, anim_id=num_anims)
+            _CheckAnimation(anims, num_anims, num_bitmaps)
+            self._WriteAnimation(out, anims, 0)
+            num_anims = num_anims + 1
+            num_frames = num_frames + anims.NumFrames()
+            num_subframes = num_subframes + anims.NumSubframes()
+        out.Flush()
+        end = self._prt_file.tell()
+        self._prt_file.seek(header)
+        self._prt_file.write(_RunStruct(UINT32, 4).pack(num_anims, num_frames, num_subframes, self.num_optional_entries))
+        self._prt_file.seek(end)
+        return num_anims, num_frames, num_subframes
+
+    def IterAnimations(self):
+        """Yields the animations one at a time.  After Load they are views into self.animations.  After Open, each one is decoded from the PRT
+        when it is reached, so only the current one is held in memory."""
+        if self.index is None:
+            for anim in self.animations:
+                yield anim
+        else:
+            for i in xrange(len(self.index.animation_offsets)):
+                yield self.GetAnimation(i)
+
+    def EncodeAnimations(self):
+        """Returns the animation table encoded as it appears in the PRT file."""
+        f = cStringIO.StringIO()
+        out = _BatchWriter(f)
+        self._WriteAnimations(out)
+        out.Flush()
+        return f.getvalue()
+
+    def Validate(self):
+        """Raises PRTWriteError if any subframe or bitmap refers to a bitmap or palette that doesn't exist, or a frame or appendix can't be
+        written."""
+        ReferenceIndex(self).Check()
+
+    def PruneUnused(self, index=None):
+        """Removes the bitmaps no subframe uses and the palettes no remaining bitmap uses, renumbering the rest (keeping their order) and the
+        references to them.  index is a ReferenceIndex of this file, if one has been built already.
+
+        Returns (bitmap_ids, palette_ids): the old IDs of the bitmaps and palettes that were kept, in their new order.
+        """
+        if index is None:
+            index = ReferenceIndex(self)
+        # renumbering dangling references would hide them
+        index.Check()
+        bitmap_ids = [i for i, rows in enumerate(index.bitmap_subframes) if rows]
+        palette_ids = sorted(set(self.bitmaps[i].palette_id for i in bitmap_ids))
+        new_bitmap_id = dict((old, new) for new, old in enumerate(bitmap_ids))
+        new_palette_id = dict((old, new) for new, old in enumerate(palette_ids))
+        anims = self.animations
+        anims.subframe_bitmap_id = array.array(anims.subframe_bitmap_id.typecode, (new_bitmap_id[b] for b in anims.subframe_bitmap_id))
+        self.bitmaps = [self.bitmaps[i] for i in bitmap_ids]
+        for bmp in self.bitmaps:
+            bmp.palette_id = new_palette_id[bmp.palette_id]
+        self.palettes = [self.palettes[i] for i in palette_ids]
+        return bitmap_ids, palette_ids
+
+    def Write(self, encoded_animations=None, animations=None):
+        """Writes the PRT and bmp files.  If given, encoded_animations (from EncodeAnimations) is written in place of the animation table.
+
+        Alternatively, animations can be any iterable of animations (e.g. an AnimationMetadataReader, see metadata, or another PRTFile's
+        IterAnimations()), which is written one animation at a time instead of self.animations.  The PRT file has to be seekable then.
+
+        The references between the records are checked first (see Validate), so nothing is written if any are broken.  Subframes are only
+        checked up front if neither encoded_animations nor animations is given; streamed animations are checked as they are written.
+        """
+        with self.metrics.Phase('prt.validate') as phase:
+            self.Validate()
+            phase.records = len(self.bitmaps) + len(self.animations.subframe_bitmap_id)
+        out = _BatchWriter(self._prt_file)
+        with self.metrics.Phase('prt.write_palettes') as phase:
+            self._WritePalettes(out)
+            phase.bytes = out.bytes_written
+            phase.records = len(self.palettes)
+        with self.metrics.Phase('prt.write_bitmaps') as phase:
+            start = out.bytes_written
+            bmp_bytes = self._WriteBitmaps(out)
+            phase.bytes = bmp_bytes + out.bytes_written - start
+            phase.records = len(self.bitmaps)
+        with self.metrics.Phase('prt.write_animations') as phase:
+            start = out.bytes_written
+            if encoded_animations is not None:
+                out.Write(encoded_animations)
+                phase.records = len(self.animations) + self.animations.NumFrames() + self.animations.NumSubframes()
+            elif animations is not None:
+                phase.records = sum(self._WriteAnimationStream(out, animations))
+            else:
+                self._WriteAnimations(out)
+                phase.records = len(self.animations) + self.animations.NumFrames() + self.animations.NumSubframes()
+            phase.bytes = out.bytes_written - start
+        with self.metrics.Phase('prt.write_extra_data') as phase:
+            # extra data
+            out.Write(self.extra_data)
+            out.Flush()
+            phase.bytes = len(self.extra_data)
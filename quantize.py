@@ -0,0 +1,159 @@
+"""Maps truecolor images onto an OP2 palette.
+
+Palette index 0 is drawn as transparent, so it is kept for the transparent pixels (alpha 0) and the other pixels are mapped onto the rest of the
+palette.  Colors in the palette map to their own entry.  Any other color is looked up through a per-palette table covering the whole RGB cube at
+LUT_BITS bits per channel, holding the entry nearest to the center of each cell, so the result is close to the nearest entry but not always it.
+The table is filled in lazily (only the cells that images actually hit are ever searched) and can be kept on disk, keyed on a hash of the palette,
+so later builds start out with every cell they have seen before.
+"""
+
+import array
+import errno
+import hashlib
+import itertools
+import operator
+import os
+
+LUT_BITS = 6
+LUT_SHIFT = 8 - LUT_BITS
+LUT_VERSION = 2
+# marks a cell whose nearest color hasn't been searched for yet
+UNFILLED = -1
+# the palette index of transparent pixels, which opaque ones never map to
+TRANSPARENT = 0
+
+class QuantizeError(Exception):
+    pass
+
+class PaletteLUT(object):
+    """Nearest-color lookup table for one palette, leaving out the transparent index 0."""
+    def __init__(self, pal, cache_dir=None):
+        self._colors = [(c.r, c.g, c.b) for c in pal.colors]
+        if len(self._colors) <= TRANSPARENT + 1:
+            raise QuantizeError('cannot map colors onto a palette without any opaque entries')
+        # exact matches always map to the first opaque entry with that color
+        self._exact = {}
+        for i in reversed(xrange(TRANSPARENT + 1, len(self._colors))):
+            self._exact[self._colors[i]] = i
+        # squared distance from each channel value to each opaque palette entry, per channel, so searches are a couple of C-level maps
+        opaque = self._colors[TRANSPARENT + 1:]
+        self._distances = [[[(c[channel] - v) * (c[channel] - v) for c in opaque] for v in xrange(256)] for channel in xrange(3)]
+        self._path = None
+        if cache_dir:
+            self._path = os.path.join(cache_dir, '%s.lut' % hashlib.sha1('%d:%d:' % (LUT_VERSION, LUT_BITS) + pal.Key()).hexdigest())
+        self._lut = None
+        if self._path:
+            try:
+                with open(self._path, 'rb') as f:
+                    lut = array.array('h')
+                    lut.fromstring(f.read())
+                if len(lut) == 1 << (3 * LUT_BITS):
+                    self._lut = lut
+            except IOError:
+                pass
+        if self._lut is None:
+            self._lut = array.array('h', [UNFILLED]) * (1 << (3 * LUT_BITS))
+        self._dirty = False
+
+    def _Search(self, r, g, b):
+        dr, dg, db = self._distances
+        dist = map(operator.add, map(operator.add, dr[r], dg[g]), db[b])
+        return dist.index(min(dist)) + TRANSPARENT + 1
+
+    def Nearest(self, r, g, b):
+        """Returns the index of an opaque palette entry close to (r, g, b): its own entry if it is in the palette, otherwise the entry nearest to
+        the center of its LUT cell."""
+        i = self._exact.get((r, g, b))
+        if i is not None:
+            return i
+        cell = ((r >> LUT_SHIFT) << (2 * LUT_BITS)) | ((g >> LUT_SHIFT) << LUT_BITS) | (b >> LUT_SHIFT)
+        i = self._lut[cell]
+        if i == UNFILLED:
+            # search for the color at the center of the cell
+            half = (1 << LUT_SHIFT) >> 1
+            i = self._Search((r >> LUT_SHIFT << LUT_SHIFT) + half, (g >> LUT_SHIFT << LUT_SHIFT) + half, (b >> LUT_SHIFT << LUT_SHIFT) + half)
+            self._lut[cell] = i
+            self._dirty = True
+        return i
+
+    def Save(self):
+        """Writes the table to the cache directory, if it has one and new cells were filled in."""
+        if not self._path or not self._dirty:
+            return
+        try:
+            os.makedirs(os.path.dirname(self._path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(self._lut.tostring())
+        os.rename(tmp_path, self._path)
+        self._dirty = False
+
+class _Memo(dict):
+    """Color -> index cache for one image, falling back to the LUT."""
+    def __init__(self, lut):
+        self._lut = lut
+
+    def __missing__(self, color):
+        i = self[color] = self._lut.Nearest(*color)
+        return i
+
+def _Clamp(v):
+    return 0 if v < 0 else 255 if v > 255 else int(v + 0.5)
+
+def _DitherRows(bmp, lut):
+    """Yields the palette indices of each row, diffusing the quantization error (Floyd-Steinberg).  Transparent pixels neither take nor pass
+    on any error."""
+    w = bmp.width
+    rgb = bmp.rgb
+    alpha = bmp.alpha
+    colors = lut._colors
+    err = [[0.0] * (w + 2) for c in xrange(3)]
+    for y in xrange(bmp.height):
+        next_err = [[0.0] * (w + 2) for c in xrange(3)]
+        row = []
+        base = y * w * 3
+        for x in xrange(w):
+            if alpha is not None and not alpha[y * w + x]:
+                row.append(TRANSPARENT)
+                continue
+            want = [rgb[base + x * 3 + c] + err[c][x + 1] for c in xrange(3)]
+            i = lut.Nearest(*[_Clamp(v) for v in want])
+            row.append(i)
+            for c in xrange(3):
+                e = want[c] - colors[i][c]
+                err[c][x + 2] += e * 7 / 16
+                next_err[c][x] += e * 3 / 16
+                next_err[c][x + 1] += e * 5 / 16
+                next_err[c][x + 2] += e * 1 / 16
+        err = next_err
+        yield row
+
+def QuantizeBitmap(bmp, lut, dither=False):
+    """Maps the truecolor pixels of bmp (see Bitmap.LoadBMP) onto the palette of lut, filling in bmp.data and dropping bmp.rgb and bmp.alpha.
+    Pixels with alpha 0 get the transparent index 0, and no other pixel does."""
+    if bmp.rgb is None:
+        raise QuantizeError('bitmap has no truecolor data')
+    if bmp.image_type in [4, 5]:
+        raise QuantizeError('truecolor images cannot be imported as 1bpp bitmaps (type %d)' % bmp.image_type)
+    w = bmp.width
+    padded_width = bmp.Stride()
+    data = bytearray(padded_width * bmp.height)
+    if dither:
+        rows = _DitherRows(bmp, lut)
+    else:
+        memo = _Memo(lut)
+        rgb = bmp.rgb
+        row_size = w * 3
+        rows = (map(memo.__getitem__, zip(rgb[y:y + row_size:3], rgb[y + 1:y + row_size:3], rgb[y + 2:y + row_size:3]))
+                for y in xrange(0, row_size * bmp.height, row_size))
+    alpha = bmp.alpha
+    for y, row in enumerate(rows):
+        if alpha is not None and not dither:
+            row = [TRANSPARENT if not a else i for i, a in itertools.izip(row, alpha[y * w:(y + 1) * w])]
+        data[y * padded_width:y * padded_width + w] = bytearray(row)
+    bmp.data = data
+    bmp.rgb = None
+    bmp.alpha = None
@@ -0,0 +1,146 @@
+"""Composites animation frames out of their subframe bitmaps, and writes them as RGBA PNG images.
+
+Each frame is drawn on a canvas the size of its animation's bounding box.  A subframe's top left corner is placed at the animation's offset plus the
+subframe's offset, relative to the top left of the bounding box, and subframes are drawn in order.  Pixels using palette index 0 are transparent.
+The 1bpp image types are shadows: set bits darken whatever has been drawn below them.
+
+Everything is done on whole rows with str.translate and slice assignment.  The per-pixel work happens once per bitmap when it is decoded, and the
+decoded bitmap is cached for every other frame that uses it.
+"""
+
+import re
+import struct
+import threading
+import zlib
+
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+PNG_CHUNK_HEADER = struct.Struct('>I 4s')
+PNG_IHDR = struct.Struct('>IIBBBBB')
+# opacity of the 1bpp shadow bitmaps
+SHADOW_ALPHA = 128
+
+_OPAQUE_RUN = re.compile('[^\x00]+')
+_SHADOW_COLOR = ''.join(chr(c * (255 - SHADOW_ALPHA) // 255) for c in xrange(256))
+_SHADOW_ALPHA = ''.join(chr(a + (255 - a) * SHADOW_ALPHA // 255) for a in xrange(256))
+
+class RenderError(Exception):
+    pass
+
+def _Signed(value):
+    """Reinterprets a uint32 field (the bounding box is stored unsigned) as signed."""
+    return value - (1 << 32) if value & 0x80000000 else value
+
+class _Sprite(object):
+    """A bitmap decoded for drawing: per row, the RGBA pixels and the [start, end) pixel runs that are drawn."""
+    def __init__(self, bmp):
+        self.width = bmp.width
+        self.height = bmp.height
+        self.shadow = bmp.image_type in [4, 5]
+        self.rows = []
+        self.runs = []
+        if not self.height:
+            return
+        if len(bmp.data) < bmp.Stride() * self.height:
+            raise RenderError('not enough data for a %dx%d bitmap' % (self.width, self.height))
+        indices = str(bmp.Indices())
+        pal = bmp.palette.data
+        red = str(pal[0::4]).ljust(256, '\x00')
+        green = str(pal[1::4]).ljust(256, '\x00')
+        blue = str(pal[2::4]).ljust(256, '\x00')
+        alpha = '\x00' + '\xff' * 255
+        for y in xrange(self.height):
+            row = indices[y * self.width:(y + 1) * self.width]
+            self.runs.append([m.span() for m in _OPAQUE_RUN.finditer(row)])
+            if not self.shadow:
+                rgba = bytearray(self.width * 4)
+                rgba[0::4] = row.translate(red)
+                rgba[1::4] = row.translate(green)
+                rgba[2::4] = row.translate(blue)
+                rgba[3::4] = row.translate(alpha)
+                self.rows.append(rgba)
+
+    def Draw(self, canvas, canvas_width, canvas_height, x, y):
+        """Draws the sprite with its top left corner at (x, y) on an RGBA canvas, clipped to its edges."""
+        for sy in xrange(max(0, -y), min(self.height, canvas_height - y)):
+            base = (y + sy) * canvas_width + x
+            for start, end in self.runs[sy]:
+                start = max(start, -x)
+                end = min(end, canvas_width - x)
+                if start >= end:
+                    continue
+                a = (base + start) * 4
+                b = (base + end) * 4
+                if self.shadow:
+                    under = canvas[a:b]
+                    darkened = bytearray(str(under).translate(_SHADOW_COLOR))
+                    darkened[3::4] = str(under[3::4]).translate(_SHADOW_ALPHA)
+                    canvas[a:b] = darkened
+                else:
+                    canvas[a:b] = self.rows[sy][start * 4:end * 4]
+
+class Renderer(object):
+    """Renders animations using get_bitmap (e.g. PRTFile.GetBitmap, or prt.bitmaps.__getitem__ after PRTFile.Load) to look up bitmaps by ID.
+
+    Decoded bitmaps are cached for the lifetime of the renderer.  Safe to use from multiple threads.
+    """
+    def __init__(self, get_bitmap):
+        self._get_bitmap = get_bitmap
+        self._sprites = {}
+        self._lock = threading.Lock()
+
+    def _Sprite(self, bitmap_id):
+        sprite = self._sprites.get(bitmap_id)
+        if sprite is None:
+            if bitmap_id < 0:
+                raise RenderError('invalid bitmap ID %d' % bitmap_id)
+            sprite = _Sprite(self._get_bitmap(bitmap_id))
+            with self._lock:
+                # another thread may have decoded it in the meantime; either copy will do
+                sprite = self._sprites.setdefault(bitmap_id, sprite)
+        return sprite
+
+    def FrameSize(self, anim):
+        """Returns the (width, height) of the frames of an animation (at least 1x1)."""
+        box = anim.bounding_box
+        return max(1, _Signed(box.right) - _Signed(box.left)), max(1, _Signed(box.bottom) - _Signed(box.top))
+
+    def RenderFrame(self, anim, frame):
+        """Returns frame (an index into anim.frames) as RGBA pixels, FrameSize(anim) in size."""
+        width, height = self.FrameSize(anim)
+        canvas = bytearray(width * height * 4)
+        offset = anim.offset
+        for sub in anim.frames[frame].subframes:
+            self._Sprite(sub.bitmap_id).Draw(canvas, width, height, offset.x + sub.offset.x, offset.y + sub.offset.y)
+        return canvas
+
+    def RenderSheet(self, anim, columns=0):
+        """Returns (width, height, pixels) of a sprite sheet with all frames of anim in a grid of the given number of columns (0 for one row)."""
+        frame_width, frame_height = self.FrameSize(anim)
+        num_frames = len(anim.frames)
+        columns = min(columns or num_frames, num_frames) or 1
+        rows = (num_frames + columns - 1) // columns or 1
+        width = columns * frame_width
+        sheet = bytearray(width * rows * frame_height * 4)
+        row_size = frame_width * 4
+        for i in xrange(num_frames):
+            frame = self.RenderFrame(anim, i)
+            left = (i % columns) * frame_width
+            top = (i // columns) * frame_height
+            for y in xrange(frame_height):
+                a = ((top + y) * width + left) * 4
+                sheet[a:a + row_size] = frame[y * row_size:(y + 1) * row_size]
+        return width, rows * frame_height, sheet
+
+def _PNGChunk(tag, data):
+    return PNG_CHUNK_HEADER.pack(len(data), tag) + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+def WritePNG(filename, width, height, pixels, compression=6):
+    """Writes RGBA pixels (top-down, unpadded rows) to a PNG file."""
+    row_size = width * 4
+    # every row uses filter type 0 (none)
+    raw = ''.join('\x00' + str(pixels[y * row_size:(y + 1) * row_size]) for y in xrange(height))
+    with open(filename, 'wb') as f:
+        f.write(PNG_SIGNATURE)
+        f.write(_PNGChunk('IHDR', PNG_IHDR.pack(width, height, 8, 6, 0, 0, 0)))
+        f.write(_PNGChunk('IDAT', zlib.compress(raw, compression)))
+        f.write(_PNGChunk('IEND', ''))
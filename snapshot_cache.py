@@ -0,0 +1,136 @@
+"""Snapshot cache for PRTFile.Load.
+
+A snapshot holds everything Load decodes from an op2_art.prt/.bmp pair except the pixel data: the palettes, the bitmap records, the animation
+table and the extra data (see PRTFile.Load).  There is one snapshot per pair of input paths.  Each records the size, mtime and hash of both inputs
+and is only used while they still match; the files are only re-hashed when their mtime changes.  Snapshots written by other versions of the tools
+are ignored and replaced.  Once the snapshots in the cache directory add up to more than max_size bytes, the least recently used are removed.
+"""
+
+import errno
+import hashlib
+import mmap
+import os
+import struct
+import threading
+
+# size, mtime and hash of the prt and bmp files
+SNAPSHOT_KEY = struct.Struct('<Q d 20s Q d 20s')
+SUFFIX = '.snap'
+DEFAULT_MAX_SIZE = 64 << 20
+
+def _HashOpenFile(f, size):
+    """Returns the sha1 digest of the first size bytes of open file f, without moving its position."""
+    if size == 0:
+        return hashlib.sha1().digest()
+    m = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+    try:
+        return hashlib.sha1(buffer(m)).digest()
+    finally:
+        m.close()
+
+class SnapshotCache(object):
+    """Stores PRTFile snapshots in cache_dir, keeping them to max_size bytes in total."""
+    def __init__(self, cache_dir, max_size=DEFAULT_MAX_SIZE):
+        self._cache_dir = cache_dir
+        self._max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        try:
+            os.makedirs(cache_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _Path(self, prt_file, bmp_file):
+        """Returns the snapshot filename for a pair of open files, or None if they aren't files on disk."""
+        names = [getattr(f, 'name', None) for f in (prt_file, bmp_file)]
+        if not all(isinstance(name, basestring) and os.path.isfile(name) for name in names):
+            return None
+        key = hashlib.sha1('\0'.join(os.path.realpath(name) for name in names)).hexdigest()
+        return os.path.join(self._cache_dir, key + SUFFIX)
+
+    def Lookup(self, prt_file, bmp_file):
+        """Returns the snapshot stored for the current contents of open files prt_file and bmp_file, or None if there isn't one.  The snapshot
+        is a read-only view into the mapped snapshot file."""
+        path = self._Path(prt_file, bmp_file)
+        if path is None:
+            self.misses = self.misses + 1
+            return None
+        try:
+            f = open(path, 'r+b')
+        except IOError:
+            self.misses = self.misses + 1
+            return None
+        with f:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size >= SNAPSHOT_KEY.size else None
+            if m is None:
+                self.misses = self.misses + 1
+                return None
+            stored = SNAPSHOT_KEY.unpack_from(m)
+            current = []
+            for i, input_file in enumerate((prt_file, bmp_file)):
+                st = os.fstat(input_file.fileno())
+                size, mtime, digest = stored[i * 3:i * 3 + 3]
+                if st.st_size != size:
+                    break
+                if st.st_mtime != mtime:
+                    # touched, but maybe not changed
+                    if _HashOpenFile(input_file, size) != digest:
+                        break
+                current.extend((size, st.st_mtime, digest))
+            else:
+                if current != list(stored):
+                    # save the next lookup from hashing the files again
+                    f.seek(0)
+                    f.write(SNAPSHOT_KEY.pack(*current))
+                # for the least recently used eviction
+                os.utime(path, None)
+                self.hits = self.hits + 1
+                return buffer(m, SNAPSHOT_KEY.size)
+        m.close()
+        self.misses = self.misses + 1
+        return None
+
+    def Store(self, prt_file, bmp_file, snapshot):
+        """Stores a snapshot (see PRTFile.Load) for the current contents of open files prt_file and bmp_file, then evicts old snapshots."""
+        path = self._Path(prt_file, bmp_file)
+        if path is None:
+            return
+        key = []
+        for input_file in (prt_file, bmp_file):
+            st = os.fstat(input_file.fileno())
+            key.extend((st.st_size, st.st_mtime, _HashOpenFile(input_file, st.st_size)))
+        tmp_path = '%s.%d.tmp' % (path, threading.current_thread().ident)
+        with open(tmp_path, 'wb') as f:
+            f.write(SNAPSHOT_KEY.pack(*key))
+            f.write(snapshot)
+        os.rename(tmp_path, path)
+        self.Evict(keep=path)
+
+    def Evict(self, keep=None):
+        """Removes the least recently used snapshots until the rest fit in max_size bytes.  The snapshot at path keep is never removed."""
+        snapshots = []
+        for name in os.listdir(self._cache_dir):
+            if name.endswith(SUFFIX):
+                path = os.path.join(self._cache_dir, name)
+                st = os.stat(path)
+                snapshots.append((path != keep, -st.st_mtime, st.st_size, path))
+        total = 0
+        for _, _, size, path in sorted(snapshots):
+            total = total + size
+            if total > self._max_size and path != keep:
+                os.remove(path)
+                total = total - size
+
+def AddArguments(parser):
+    """Adds the --snapshot_cache and --snapshot_cache_size options to an argparse parser."""
+    parser.add_argument('--snapshot_cache', metavar='DIR', help='Directory in which to keep snapshots of the decoded op2_art data, so that later '
+        'runs on the same unchanged files start faster.')
+    parser.add_argument('--snapshot_cache_size', type=int, default=DEFAULT_MAX_SIZE >> 20, metavar='MIB', help='Size limit of the snapshot '
+        'cache in MiB (default %d); the least recently used snapshots are removed beyond it.' % (DEFAULT_MAX_SIZE >> 20))
+
+def FromArguments(args):
+    """Returns the SnapshotCache requested by the AddArguments options, or None."""
+    if not args.snapshot_cache:
+        return None
+    return SnapshotCache(args.snapshot_cache, max_size=args.snapshot_cache_size << 20)
@@ -0,0 +1,72 @@
+"""Generates synthetic op2_art.prt/.bmp pairs, for benchmarking and testing without the original game files.
+
+The contents are random, but deterministic for a given seed, and cover every feature of the format that the tools have to preserve: the optional
+frame bytes, appendices, the 1bpp image types and trailing extra data.
+"""
+
+import binascii
+import random
+
+import bitmap
+import palette
+import prt_file
+
+def _RandomBytes(rng, size):
+    """Returns size random bytes from random.Random rng, generated in one go."""
+    if size == 0:
+        return bytearray()
+    return bytearray(binascii.unhexlify('%0*x' % (size * 2, rng.getrandbits(size * 8))))
+
+def GenerateArt(prt, bmp, seed=0, num_palettes=8, num_bitmaps=1000, num_animations=500, max_frames=8, max_subframes=4, max_bitmap_size=64,
+        shadow_fraction=0.1, optional_fraction=0.3, max_appendix=3, extra_data_size=1024):
+    """Writes a random PRT/BMP pair to open files prt and bmp, and returns the PRTFile it was written from.
+
+    Animations get 0 to max_frames frames and each frame 0 to max_subframes subframes; the frame and subframe counts are as close to the averages this
+    implies as the random numbers allow.  shadow_fraction of the bitmaps are 1bpp (types 4 and 5), optional_fraction of the frames carry each of the
+    two pairs of optional bytes, and each animation has 0 to max_appendix appendix rows.
+    """
+    if num_palettes < 1 and num_bitmaps:
+        raise ValueError('bitmaps need at least one palette')
+    if num_bitmaps < 1 and num_animations and max_frames and max_subframes:
+        raise ValueError('subframes need at least one bitmap')
+    if max_subframes > 0x7F:
+        raise ValueError('frames can have at most 127 subframes')
+    rng = random.Random(seed)
+    out = prt_file.PRTFile(prt, bmp)
+    for i in xrange(num_palettes):
+        pal = palette.Palette()
+        pal.data = _RandomBytes(rng, 256 * 4)
+        out.palettes.append(pal)
+    for i in xrange(num_bitmaps):
+        b = bitmap.Bitmap()
+        b.width = rng.randint(1, max_bitmap_size)
+        b.height = rng.randint(1, max_bitmap_size)
+        b.image_type = rng.choice([4, 5]) if rng.random() < shadow_fraction else rng.choice([0, 1, 2, 3])
+        b.palette_id = rng.randrange(num_palettes)
+        b.palette = out.palettes[b.palette_id]
+        b.data = _RandomBytes(rng, b.Stride() * b.height)
+        out.bitmaps.append(b)
+    anims = out.animations
+    for i in xrange(num_animations):
+        left = rng.randint(-64, 0)
+        top = rng.randint(-64, 0)
+        box = (left & 0xFFFFFFFF, top & 0xFFFFFFFF, rng.randint(1, 64), rng.randint(1, 64))
+        anim = anims.AddAnimation(rng.randrange(1 << 16), box, (rng.randint(0, 64), rng.randint(0, 64)), rng.randrange(1 << 16))
+        for j in xrange(rng.randint(0, max_frames)):
+            optional = [None] * 4
+            if rng.random() < optional_fraction:
+                optional[0:2] = rng.randrange(256), rng.randrange(256)
+            if rng.random() < optional_fraction:
+                optional[2:4] = rng.randrange(256), rng.randrange(256)
+            frame = anims.AddFrame(anim, rng.randrange(0x80), *optional)
+            subframes = []
+            for k in xrange(rng.randint(0, max_subframes)):
+                subframes.extend([rng.randrange(num_bitmaps), rng.randrange(256), k, rng.randint(-64, 64), rng.randint(-64, 64)])
+            anims.AddSubframes(frame, subframes)
+        appendix = [rng.randrange(1 << 32) for k in xrange(rng.randint(0, max_appendix) * 4)]
+        anims.anim_unknown3[anim] = len(appendix) // 4
+        anims.SetAppendix(anim, appendix)
+    out.num_optional_entries = rng.randrange(1 << 16)
+    out.extra_data.extend(_RandomBytes(rng, extra_data_size))
+    out.Write()
+    return out